@@ -1,7 +1,5 @@
 import pandas as pd
 import numpy as np
-import copy
-from scipy.interpolate import interp1d
 
 
 def get_date(date_string):
@@ -53,36 +51,113 @@ def change_date_format_investingcom_to_yahoo(date_string):
     return date_string_mod
 
 
-def is_date_between_dates(date, date_start=None, date_end=None):
-    day, month, year = get_date(date)
+def get_date_ordinals(dates):
+    """
+    Convert a date string in the "Yahoo finance" format YYYY-MM-DD, or a sequence of them, to int32 day ordinals
+    (days since 1970-01-01). datetime64 arrays, ordinal arrays and DateIndex objects are accepted as well.
+    """
+    if isinstance(dates, DateIndex):
+        return dates.ordinals
+    if isinstance(dates, str):
+        return np.datetime64(dates, 'D').astype(np.int32)
+    dates = np.asarray(dates)
+    if np.issubdtype(dates.dtype, np.integer):
+        return dates.astype(np.int32, copy=False)
+    return dates.astype('datetime64[D]').astype(np.int32)
 
-    after_start_date = True
-    if date_start is not None:
-        day_start, month_start, year_start = get_date(date_start)
-        if (year > year_start) or (year == year_start and month > month_start) \
-                or (year == year_start and month == month_start and day >= day_start):
-            after_start_date = True
-        else:
-            after_start_date = False
 
-    before_end_date = True
-    if date_end is not None:
-        day_end, month_end, year_end = get_date(date_end)
-        if (year < year_end) or (year == year_end and month < month_end) \
-                or (year == year_end and month == month_end and day <= day_end):
-            before_end_date = True
+def get_date_components(ordinals):
+    """
+    vectorized version of get_date, returns the day, month, year arrays of day ordinals
+    """
+    dates = np.asarray(ordinals).astype('datetime64[D]')
+    months = dates.astype('datetime64[M]')
+    year = months.astype(np.int64) // 12 + 1970
+    month = months.astype(np.int64) % 12 + 1
+    day = (dates - months).astype(np.int64) + 1
+    return day, month, year
+
+
+def get_days_array(ordinals, ordinal_reference):
+    """
+    vectorized version of get_number_of_days_between_dates, same 365 days a year with equally sized months convention
+    """
+    day, month, year = get_date_components(ordinals)
+    day_ref, month_ref, year_ref = get_date_components(ordinal_reference)
+    num_days = year * 365.0 + month * 365.0 / 12 + day
+    num_days_ref = year_ref * 365.0 + month_ref * 365.0 / 12 + day_ref
+    return num_days - num_days_ref
+
+
+class DateIndex:
+    """
+    Dates sorted from past to future, held as an int32 array of day ordinals.
+    Lookups and restriction to a time interval are done with np.searchsorted, so no date strings are parsed.
+    """
+
+    def __init__(self, dates):
+        self.ordinals = get_date_ordinals(dates)
+        if np.any(np.diff(self.ordinals) <= 0):
+            raise ValueError('dates of DateIndex must be unique and sorted from past to future.')
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def __getitem__(self, inds):
+        return DateIndex(self.ordinals[inds])
+
+    def get_dates(self):
+        """
+        the dates as a list of YYYY-MM-DD strings
+        """
+        return np.datetime_as_string(self.ordinals.astype('datetime64[D]')).tolist()
+
+    def get_slice_between_dates(self, date_start=None, date_end=None):
+        """
+        slice of the dates that are between date_start and date_end (inclusive)
+        """
+        ind_start = 0
+        if date_start is not None:
+            ind_start = int(np.searchsorted(self.ordinals, get_date_ordinals(date_start), side='left'))
+        ind_end = len(self.ordinals)
+        if date_end is not None:
+            ind_end = int(np.searchsorted(self.ordinals, get_date_ordinals(date_end), side='right'))
+        return slice(ind_start, max(ind_start, ind_end))
+
+    def get_index_of_date(self, date_to_find):
+        ordinal = get_date_ordinals(date_to_find)
+        ind = int(np.searchsorted(self.ordinals, ordinal))
+        if ind == len(self.ordinals) or self.ordinals[ind] != ordinal:
+            raise ValueError(str(date_to_find) + ' is not found in the dates list.')
+        return ind
+
+    def get_days_array(self, date_reference=None):
+        """
+        count the days passed relative to a reference date (first date by default)
+        """
+        if date_reference is None:
+            ordinal_reference = self.ordinals[0]
         else:
-            before_end_date = False
+            ordinal_reference = get_date_ordinals(date_reference)
+        return get_days_array(self.ordinals, ordinal_reference)
+
 
+def is_date_between_dates(date, date_start=None, date_end=None):
+    ordinal = get_date_ordinals(date)
+    after_start_date = date_start is None or ordinal >= get_date_ordinals(date_start)
+    before_end_date = date_end is None or ordinal <= get_date_ordinals(date_end)
     date_is_between_dates = after_start_date and before_end_date
     return date_is_between_dates
 
 
 def get_inds_between_dates(dates, date_start=None, date_end=None):
-    inds_restricted = []
-    for i, date in enumerate(dates):
-        if is_date_between_dates(date, date_start, date_end):
-            inds_restricted += [i]
+    ordinals = get_date_ordinals(dates)
+    is_between_dates = np.ones(len(ordinals), dtype=bool)
+    if date_start is not None:
+        is_between_dates &= ordinals >= get_date_ordinals(date_start)
+    if date_end is not None:
+        is_between_dates &= ordinals <= get_date_ordinals(date_end)
+    inds_restricted = np.nonzero(is_between_dates)[0].tolist()
     return inds_restricted
 
 
@@ -102,42 +177,39 @@ def transform_to_days_array(dates, date_reference=None):
     """
     Instead of dealing with strings of dates, count the days passed relative to a reference date
     """
+    ordinals = get_date_ordinals(dates)
     if date_reference is None:
-        date_reference = dates[0]
-    days_array = []
-    for date in dates:
-        days_array += [get_number_of_days_between_dates(date, date_reference)]
-    return days_array
+        ordinal_reference = ordinals[0]
+    else:
+        ordinal_reference = get_date_ordinals(date_reference)
+    return get_days_array(ordinals, ordinal_reference)
 
 
 def get_index_of_date(dates, date_to_find):
     """
     Get the index in a dates array for a specific date
     """
-    for i, date in enumerate(dates):
-        if get_number_of_days_between_dates(date, date_to_find) == 0:
-            return i
-    raise ValueError(date_to_find + ' is not found in the dates list.')
+    if not isinstance(dates, DateIndex):
+        dates = DateIndex(dates)
+    return dates.get_index_of_date(date_to_find)
 
 
 def interpolate_between_dates(dates, values, date_to_interpolate):
     """
     Based on samples of dates and values, interpolate to a specific date
     """
-    date_before = None
-    for i, date in enumerate(dates):
-        if is_date_between_dates(date, date_start=date_to_interpolate, date_end=None):
-            date_before = date
-            value_before = values[i]
-            if i == len(dates):
-                raise ValueError('requested date ' + date_to_interpolate + ' is not in the date range')
-            date_after = dates[i - 1]
-            value_after = values[i - 1]
-            break
-
-    days_to_interp = get_number_of_days_between_dates(date_to_interpolate, date_before)
-    days_range = get_number_of_days_between_dates(date_after, date_before)
-    value_interp = value_before + days_to_interp / days_range * (value_after - value_before)
+    if not isinstance(dates, DateIndex):
+        dates = DateIndex(dates)
+    ordinal = get_date_ordinals(date_to_interpolate)
+    i = int(np.searchsorted(dates.ordinals, ordinal, side='left'))
+    if i == len(dates) or (i == 0 and dates.ordinals[0] != ordinal):
+        raise ValueError('requested date ' + str(date_to_interpolate) + ' is not in the date range')
+    if dates.ordinals[i] == ordinal:
+        return values[i]
+
+    days_to_interp = get_days_array(ordinal, dates.ordinals[i])
+    days_range = get_days_array(dates.ordinals[i - 1], dates.ordinals[i])
+    value_interp = values[i] + days_to_interp / days_range * (values[i - 1] - values[i])
     return value_interp
 
 
@@ -0,0 +1,421 @@
+import warnings
+import numpy as np
+from metrics_functions import calculate_risk_metrics_batch
+from market_functions import load_data, iterate_synthetic_paths, get_days_between_invests, \
+    get_days_between_rebalances
+
+
+def simulate_portfolio_evolution_batch(settings, seeds, batch_size=None, portfolio_fractions_list=None):
+    """
+    Simulate a batch of realizations of the portfolio together, one realization per seed (the seed of the synthetic
+    realization, see generate_synthetic_realization; for back-testing all the realizations are the same).
+    The state of all the realizations is kept in (realizations x stocks) arrays that are advanced day by day, and
+    the invest, rebalance and margin decisions are boolean masks over the realizations.
+    Follows simulate_portfolio_evolution operation by operation, for portfolios without yearly capital gains tax
+    (tax_scheme 'none'). The papers are kept per realization only if there is a final sell tax, since the profit of
+    the final sell depends on the order the papers were sold in.
+    The seeds are simulated in chunks of batch_size realizations (default all together).
+    Returns the per-realization total_yield, total_yield_tax_free, yield_min, yield_max and max_drawdown, and for the
+    full record also the other metrics of calculate_risk_metrics_batch over the kept (realizations x days) yield history.
+    If portfolio_fractions_list (a list of ideal_portfolio_fractions dicts) is given, all the fraction variants are
+    simulated together over the same paths, which are loaded and generated once, and every result is a
+    (variants x realizations) array. The stocks of all the variants are loaded together, so a variant is simulated on
+    the dates common to all the stocks even if some of its fractions are 0.
+    """
+    if settings['tax_scheme'] != 'none':
+        raise ValueError('batch simulation supports only tax_scheme none without capital gains tax, got tax_scheme = '
+                         + str(settings['tax_scheme']))
+
+    if portfolio_fractions_list is None:
+        fractions_list = [settings['ideal_portfolio_fractions']]
+    else:
+        fractions_list = portfolio_fractions_list
+        for portfolio_fractions in fractions_list:
+            for stock_name, fraction in portfolio_fractions.items():
+                if fraction < 0:
+                    raise ValueError('negative portfolio fraction for ' + str(stock_name))
+        # load the stocks that have a positive fraction in any of the variants
+        stock_fractions = {}
+        for portfolio_fractions in fractions_list:
+            for stock_name, fraction in portfolio_fractions.items():
+                stock_fractions[stock_name] = max(stock_fractions.get(stock_name, 0), fraction)
+        settings = dict(settings, ideal_portfolio_fractions=stock_fractions)
+
+    # load all necessary data for simulation
+    settings, data = load_data(settings)
+    stock_names = list(settings['ideal_portfolio_fractions'].keys())
+    ideal_fractions = np.array([[portfolio_fractions.get(stock_name, 0.0) for stock_name in stock_names]
+                                for portfolio_fractions in fractions_list])
+
+    results = {}
+    for batch_seeds, paths in iterate_synthetic_paths(settings, data, seeds, batch_size or max(len(seeds), 1)):
+        # the realizations of the batch are (variant, path) pairs, the variants share the paths of the chunk
+        num_paths = len(batch_seeds)
+        batch = {}
+        batch['stock_names'] = stock_names
+        batch['num_realizations'] = len(fractions_list) * num_paths
+        batch['num_days'] = paths['daily_factors'].shape[1]
+        batch['daily_factors'] = paths['daily_factors']
+        batch['dividend_fractions'] = paths['dividend_fractions']
+        batch['inds_path'] = np.tile(np.arange(num_paths), len(fractions_list))
+        batch['ideal_fractions'] = np.repeat(ideal_fractions, num_paths, axis=0)
+
+        batch = initialize_portfolio_batch(settings, batch)
+        for ind_date in range(1, batch['num_days']):
+            batch = simulate_portfolio_single_day_batch(settings, batch, ind_date)
+
+        # end of simulation period reached, calculate profit if entire portfolio sold now
+        for key, values in calculate_total_portfolio_yield_batch(settings, batch).items():
+            results.setdefault(key, []).append(values.reshape(len(fractions_list), num_paths))
+
+    results = {key: np.concatenate(values, axis=1) for key, values in results.items()}
+    if portfolio_fractions_list is None:
+        results = {key: values[0] for key, values in results.items()}
+    return results
+
+
+def initialize_portfolio_batch(settings, batch):
+    """
+    first purchase of stocks according to the required fractions of each realization (batch['ideal_fractions'], as
+    (realizations x stocks)), see initialize_portfolio
+    """
+    stock_names = batch['stock_names']
+    num_realizations = batch['num_realizations']
+    if np.any(np.sum(batch['ideal_fractions'], axis=1) != 1.0):
+        raise ValueError('portfolio_fractions do not add up to 100%')
+    if settings['margin_leverage_target'] < 1.0:
+        raise ValueError('margin_leverage_target must be greater than 1.')
+    if settings['record'] not in ['full', 'summary']:
+        raise ValueError('invalid record: ' + str(settings['record']))
+
+    batch['is_nominal'] = np.ones(num_realizations, dtype=bool)
+    batch['growth_index'] = np.ones([num_realizations, len(stock_names)])
+    batch['position_units'] = np.zeros([num_realizations, len(stock_names)])
+
+    # the papers of each (realization, stock), kept only if the profit of the final sell is taxed
+    batch['track_papers'] = settings['total_sell_capital_gains_tax_percents'] != 0
+    capacity = 16
+    batch['paper_value_at_buy'] = np.zeros([num_realizations, len(stock_names), capacity])
+    batch['paper_units'] = np.zeros([num_realizations, len(stock_names), capacity])
+    batch['paper_is_open'] = np.zeros([num_realizations, len(stock_names), capacity], dtype=bool)
+    batch['num_papers'] = np.zeros([num_realizations, len(stock_names)], dtype=int)
+
+    for ind_stock in range(len(stock_names)):
+        value_at_buy = batch['ideal_fractions'][:, ind_stock] * settings['initial_investment'] \
+                       * (1 - settings['transaction_fee_percents'] / 100.0) \
+                       * settings['margin_leverage_target']
+        # stocks with a zero fraction are not bought (as if they were not in the portfolio)
+        inds_buy = np.nonzero(value_at_buy > 0)[0]
+        batch = buy_papers_batch(batch, inds_buy, ind_stock, value_at_buy[inds_buy])
+
+    batch['total_investment'] = np.full(num_realizations, float(settings['initial_investment']))
+    batch['gains'] = np.zeros(num_realizations)
+    batch['cash_in_account'] = np.full(num_realizations,
+                                       - settings['initial_investment'] * (settings['margin_leverage_target'] - 1.0))
+    batch = calculate_portfolio_fractions_batch(settings, batch)
+    batch = calculate_margin_state_batch(settings, batch)
+
+    # streaming risk metrics of the yield history (see calculate_risk_metrics)
+    yield_history = (batch['total_portfolio_value'] - batch['margin_debt']) / batch['total_investment']
+    batch['yield_min'] = yield_history.copy()
+    batch['yield_max'] = yield_history.copy()
+    batch['yield_peak'] = np.fmax(0, yield_history)  # the running maximum of the drawdown starts at 0
+    batch['max_drawdown'] = 1 - yield_history / batch['yield_peak']
+    if settings['record'] == 'full':
+        batch['yield_history'] = np.nan * np.zeros([num_realizations, batch['num_days']])
+        batch['yield_history'][:, 0] = yield_history
+
+    batch['days_since_invest'] = 0
+    batch['days_since_rebalance'] = np.zeros(num_realizations, dtype=int)
+    return batch
+
+
+def buy_papers_batch(batch, inds_realizations, ind_stock, values):
+    """
+    buy a new paper of a stock in each of the given realizations, see LotBook.add_lot
+    """
+    units = values / batch['growth_index'][inds_realizations, ind_stock]
+    batch['position_units'][inds_realizations, ind_stock] += units
+    if batch['track_papers'] and len(inds_realizations) > 0:
+        inds_papers = batch['num_papers'][inds_realizations, ind_stock]
+        capacity = batch['paper_units'].shape[2]
+        if np.max(inds_papers) >= capacity:
+            # double the size of the paper arrays
+            for array_name in ['paper_value_at_buy', 'paper_units', 'paper_is_open']:
+                batch[array_name] = np.concatenate([batch[array_name], np.zeros_like(batch[array_name])], axis=2)
+        batch['paper_value_at_buy'][inds_realizations, ind_stock, inds_papers] = values
+        batch['paper_units'][inds_realizations, ind_stock, inds_papers] = units
+        batch['paper_is_open'][inds_realizations, ind_stock, inds_papers] = True
+        batch['num_papers'][inds_realizations, ind_stock] += 1
+    return batch
+
+
+def sell_papers_batch(batch, inds_realizations, ind_stock, amounts):
+    """
+    Sell an amount of a stock in each of the given realizations, the papers in the order of the 'none' tax scheme
+    (least profitable first, see LotBook), and add the profit to the gains.
+    """
+    growth_index = batch['growth_index'][inds_realizations, ind_stock]
+    if not batch['track_papers']:
+        # the gains only matter for the final sell tax, so only the position is reduced
+        position_values = batch['position_units'][inds_realizations, ind_stock] * growth_index
+        batch['position_units'][inds_realizations, ind_stock] = np.where(
+            amounts >= position_values, 0.0, batch['position_units'][inds_realizations, ind_stock]
+                                             - amounts / growth_index)
+        return batch
+
+    num_papers = np.max(batch['num_papers'][inds_realizations, ind_stock])
+    value_at_buy = batch['paper_value_at_buy'][inds_realizations, ind_stock, :num_papers]
+    units = batch['paper_units'][inds_realizations, ind_stock, :num_papers]
+    is_open = batch['paper_is_open'][inds_realizations, ind_stock, :num_papers]
+
+    # sell order from least to most profitable, profits within the rounding of the units taken as zero and ties by order
+    # of purchase, see LotBook.sort_sell_order
+    sell_keys = units * growth_index[:, None] - value_at_buy
+    sell_keys[np.abs(sell_keys) <= 1e-12 * value_at_buy] = 0.0
+    sell_keys[~is_open] = np.inf
+    inds_order = np.argsort(sell_keys, axis=1, kind='stable')
+    value_at_buy = np.take_along_axis(value_at_buy, inds_order, axis=1)
+    units = np.take_along_axis(units, inds_order, axis=1)
+    is_open = np.take_along_axis(is_open, inds_order, axis=1)
+    paper_values = units * growth_index[:, None]
+    paper_profits = paper_values - value_at_buy
+
+    # amount left to sell before each paper, papers are closed until one has enough value to cover the amount left
+    amounts_left = np.cumsum(np.concatenate([amounts[:, None], - paper_values[:, :-1]], axis=1), axis=1)
+    is_partial = is_open & (paper_values >= amounts_left)
+    has_partial = np.any(is_partial, axis=1)
+    inds_partial = np.where(has_partial, np.argmax(is_partial, axis=1), num_papers)
+    is_closed = is_open & (np.arange(num_papers)[None, :] < inds_partial[:, None])
+
+    # the gains and position are reduced paper by paper in the sell order, to round the same as the serial simulation
+    gains = batch['gains'][inds_realizations]
+    position_units = batch['position_units'][inds_realizations, ind_stock]
+    for ind_paper in range(min(np.max(inds_partial) + 1, num_papers)):
+        gains += np.where(is_closed[:, ind_paper], paper_profits[:, ind_paper], 0)
+        position_units -= np.where(is_closed[:, ind_paper], units[:, ind_paper], 0)
+    units = np.where(is_closed, 0, units)
+    is_open = is_open & ~is_closed
+
+    rows = np.nonzero(has_partial)[0]
+    cols = inds_partial[rows]
+    amount_left = amounts_left[rows, cols]
+    profit = paper_profits[rows, cols]
+    gains[rows] += np.sign(profit) * np.minimum(profit, amount_left)
+    units[rows, cols] -= amount_left / growth_index[rows]
+    position_units[rows] -= amount_left / growth_index[rows]
+    # a liquidated position is set to exactly zero instead of the rounding residue of the sum, see LotBook.close_lot
+    position_units = np.where(np.any(is_open, axis=1), position_units, 0.0)
+
+    # back to the order of purchase
+    inds_inverse = np.argsort(inds_order, axis=1)
+    batch['paper_units'][inds_realizations, ind_stock, :num_papers] = np.take_along_axis(units, inds_inverse, axis=1)
+    batch['paper_is_open'][inds_realizations, ind_stock, :num_papers] = np.take_along_axis(is_open, inds_inverse,
+                                                                                           axis=1)
+    batch['position_units'][inds_realizations, ind_stock] = position_units
+    batch['gains'][inds_realizations] = gains
+    return batch
+
+
+def simulate_portfolio_single_day_batch(settings, batch, ind_date):
+    """
+    a single day of all the realizations, see simulate_portfolio_single_day
+    """
+    batch = calculate_portfolio_fractions_batch(settings, batch)
+    batch = evolve_portfolio_single_day_batch(settings, batch, ind_date)
+
+    # the invest schedule is the same for all the realizations
+    if batch['days_since_invest'] >= get_days_between_invests(settings):
+        batch = add_cash_to_portfolio_batch(settings, batch)
+
+    is_rebalance = batch['is_nominal'] & check_rebalancing_criterion_reached_batch(settings, batch)
+    if np.any(is_rebalance):
+        batch = rebalance_portfolio_batch(settings, batch, np.nonzero(is_rebalance)[0])
+
+    # streaming risk metrics of the yield history
+    yield_history = (batch['total_portfolio_value'] - batch['margin_debt']) / batch['total_investment']
+    batch['yield_min'] = np.fmin(batch['yield_min'], yield_history)
+    batch['yield_max'] = np.fmax(batch['yield_max'], yield_history)
+    batch['yield_peak'] = np.fmax(batch['yield_peak'], yield_history)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        batch['max_drawdown'] = np.fmax(batch['max_drawdown'], 1 - yield_history / batch['yield_peak'])
+    if settings['record'] == 'full':
+        batch['yield_history'][:, ind_date] = yield_history
+    return batch
+
+
+def calculate_portfolio_fractions_batch(settings, batch):
+    """
+    sum up the current fractions and total value, see calculate_portfolio_fractions.
+    realizations whose portfolio is nulled fail.
+    """
+    values = batch['position_units'] * batch['growth_index']
+    total_portfolio_value = 0
+    for ind_stock in range(len(batch['stock_names'])):
+        total_portfolio_value = total_portfolio_value + values[:, ind_stock]
+    batch['is_nominal'] &= total_portfolio_value > 0
+    batch['total_portfolio_value'] = total_portfolio_value
+    with np.errstate(divide='ignore', invalid='ignore'):
+        batch['portfolio_fractions'] = values / total_portfolio_value[:, None]
+    return batch
+
+
+def calculate_margin_state_batch(settings, batch, inds_realizations=None):
+    """
+    update current margin debt and margin leverage of the given realizations (default all), see calculate_margin_state
+    """
+    if inds_realizations is None:
+        batch['margin_debt'] = np.where(batch['cash_in_account'] < 0, - batch['cash_in_account'], 0)
+    else:
+        cash_in_account = batch['cash_in_account'][inds_realizations]
+        batch['margin_debt'][inds_realizations] = np.where(cash_in_account < 0, - cash_in_account, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        batch['margin_leverage'] = batch['total_portfolio_value'] \
+                                   / (batch['total_portfolio_value'] - batch['margin_debt'])
+    return batch
+
+
+def evolve_portfolio_single_day_batch(settings, batch, ind_date):
+    """
+    evolve the stocks of all the realizations by a day, see evolve_portfolio_single_day
+    """
+    # add margin loan rate that decreases the cash further every day
+    margin_rate_factor = 1 + settings['margin_rate_percents'] / 100.0 / settings['num_trading_days_in_year']
+    batch['cash_in_account'] = np.where(batch['cash_in_account'] < 0, batch['cash_in_account'] * margin_rate_factor,
+                                        batch['cash_in_account'])
+    batch = calculate_margin_state_batch(settings, batch)
+
+    batch['growth_index'] *= batch['daily_factors'][batch['inds_path'], ind_date, :]
+    # rescale the units if the growth index is about to underflow/overflow, or reset them if the value was wiped out
+    is_rescaled = ~((batch['growth_index'] > 1e-100) & (batch['growth_index'] < 1e100))
+    if np.any(is_rescaled):
+        inds_realizations, inds_stocks = np.nonzero(is_rescaled)
+        growth_index = batch['growth_index'][inds_realizations, inds_stocks]
+        batch['paper_units'][inds_realizations, inds_stocks, :] *= growth_index[:, None]
+        batch['position_units'][inds_realizations, inds_stocks] *= growth_index
+        batch['growth_index'][inds_realizations, inds_stocks] = 1.0
+
+    # we assume the dividends are given on a daily basis for simplicity
+    dividends = batch['position_units'] * batch['growth_index'] * batch['dividend_fractions'][batch['inds_path'], ind_date, :]
+    for ind_stock in range(len(batch['stock_names'])):
+        batch['gains'] += dividends[:, ind_stock]
+        batch['cash_in_account'] += dividends[:, ind_stock]
+
+    batch['days_since_invest'] += 1
+    batch['days_since_rebalance'] += 1
+    return batch
+
+
+def add_cash_to_portfolio_batch(settings, batch):
+    """
+    add cash to account and invest the positive cash of each realization, see add_cash_to_portfolio
+    """
+    batch['days_since_invest'] = 0
+    batch['total_investment'] += settings['periodic_investment']
+    batch['cash_in_account'] += settings['periodic_investment']
+    batch = calculate_margin_state_batch(settings, batch)
+
+    inds_realizations = np.nonzero(batch['is_nominal'] & (batch['cash_in_account'] > 0))[0]
+    cash_list = batch['cash_in_account'][inds_realizations, None] * batch['ideal_fractions'][inds_realizations]
+    cash_list *= (1 - settings['transaction_fee_percents'] / 100.0)
+    for ind_stock in range(len(batch['stock_names'])):
+        is_buy = cash_list[:, ind_stock] > 0
+        batch = buy_papers_batch(batch, inds_realizations[is_buy], ind_stock, cash_list[is_buy, ind_stock])
+    batch['cash_in_account'][inds_realizations] = 0
+    return batch
+
+
+def check_rebalancing_criterion_reached_batch(settings, batch):
+    """
+    mask of the realizations that reached a rebalancing criterion, see check_rebalancing_criterion_reached
+    """
+    if settings['rebalance_criterion'] not in ['percent_deviation', 'monthly', 'quarterly', 'yearly']:
+        raise ValueError('invalid rebalance_criterion: ' + str(settings['rebalance_criterion']))
+
+    is_rebalance = batch['days_since_rebalance'] >= get_days_between_rebalances(settings)
+
+    if settings['rebalance_criterion'] == 'percent_deviation':
+        stock_percent_ideal = batch['ideal_fractions'] * 100.0
+        stock_percent_curr = batch['portfolio_fractions'] * 100.0
+        is_rebalance |= np.any(np.abs(stock_percent_ideal - stock_percent_curr)
+                               > settings['rebalance_percent_deviation'], axis=1)
+
+    if settings['margin_leverage_target'] > 1:
+        margin_deviation_percents = np.abs(batch['margin_leverage'] - settings['margin_leverage_target']) \
+                                    / settings['margin_leverage_target'] * 100.0
+        is_rebalance |= margin_deviation_percents > settings['margin_leverage_percent_deviation']
+
+    return is_rebalance
+
+
+def rebalance_portfolio_batch(settings, batch, inds_realizations):
+    """
+    sell and buy stocks to rebalance the portfolio of the given realizations, see rebalance_portfolio
+    """
+    batch['days_since_rebalance'][inds_realizations] = 0
+
+    # when using margin leverage, calculate how much needs to be increased or reduced
+    total_portfolio_value = batch['total_portfolio_value'][inds_realizations]
+    margin_debt = batch['margin_debt'][inds_realizations]
+    leverage_target = settings['margin_leverage_target']
+    delta_loan = leverage_target * (total_portfolio_value - margin_debt) - total_portfolio_value
+
+    # calculate how much needs to be bought or sold from each stock type
+    ideal_fractions = batch['ideal_fractions'][inds_realizations]
+    transfers = total_portfolio_value[:, None] \
+                * (ideal_fractions - batch['portfolio_fractions'][inds_realizations]) \
+                + ideal_fractions * delta_loan[:, None]
+
+    # negative transfers are positions that need to be reduced in size, so sell papers
+    for ind_stock in range(len(batch['stock_names'])):
+        is_sell = transfers[:, ind_stock] < 0
+        if np.any(is_sell):
+            amounts = np.abs(transfers[is_sell, ind_stock]) / (1 - settings['transaction_fee_percents'] / 100.0)
+            batch = sell_papers_batch(batch, inds_realizations[is_sell], ind_stock, amounts)
+
+    # positive transfers are positions that need to be increased, so buy new papers accordingly
+    for ind_stock in range(len(batch['stock_names'])):
+        is_buy = transfers[:, ind_stock] > 0
+        amounts = np.abs(transfers[is_buy, ind_stock]) * (1 - settings['transaction_fee_percents'] / 100.0)
+        batch = buy_papers_batch(batch, inds_realizations[is_buy], ind_stock, amounts)
+
+    # update total portfolio value, cash and margin
+    batch['total_portfolio_value'][inds_realizations] += delta_loan
+    batch['cash_in_account'][inds_realizations] -= delta_loan
+    batch = calculate_margin_state_batch(settings, batch, inds_realizations)
+    return batch
+
+
+def calculate_total_portfolio_yield_batch(settings, batch):
+    """
+    profit of each realization if the entire portfolio is sold at the end, see calculate_total_portfolio_yield
+    """
+    results = {}
+    total_profit = np.zeros(batch['num_realizations'])
+    if batch['track_papers']:
+        paper_profits = batch['paper_units'] * batch['growth_index'][:, :, None] - batch['paper_value_at_buy']
+        total_profit = np.sum(np.where(batch['paper_is_open'], paper_profits, 0), axis=(1, 2))
+        # use carried over losses from previous years, if they exist
+        total_profit += np.minimum(batch['gains'], 0)
+    # in the final sell, an overall loss will not earn a gain
+    total_profit = np.maximum(total_profit, 0)
+
+    total_portfolio_after_sell = batch['total_portfolio_value'] * (1 - settings['transaction_fee_percents'] / 100.0)
+    total_portfolio_after_sell -= batch['margin_debt']  # cover margin after total sell
+    capital_gains_tax_to_pay = total_profit * settings['total_sell_capital_gains_tax_percents'] / 100.0
+
+    is_nominal = batch['is_nominal']
+    if settings['record'] == 'full':
+        # the metrics of the failed realizations are not defined (nan, without warnings of all-nan rows)
+        yield_history = np.where(is_nominal[:, None], batch['yield_history'], np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            results.update(calculate_risk_metrics_batch(yield_history, settings['num_trading_days_in_year']))
+    results['total_yield'] = np.where(is_nominal, (total_portfolio_after_sell - capital_gains_tax_to_pay)
+                                      / batch['total_investment'], -1.0)
+    results['total_yield_tax_free'] = np.where(is_nominal, total_portfolio_after_sell / batch['total_investment'],
+                                               -1.0)
+    results['yield_min'] = np.where(is_nominal, batch['yield_min'], -1.0)
+    results['yield_max'] = np.where(is_nominal, batch['yield_max'], 1.0)
+    results['max_drawdown'] = np.where(is_nominal, batch['max_drawdown'], 2.0)
+    return results
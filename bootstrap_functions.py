@@ -0,0 +1,120 @@
+import hashlib
+import numpy as np
+
+
+def get_random_integers(rng, low, high, size):
+    """
+    random integers in [low, high) from the generator rng, or from the global numpy random generator if rng is None
+    """
+    if rng is None:
+        return np.random.randint(low=low, high=high, size=size)
+    return rng.integers(low=low, high=high, size=size)
+
+
+def get_random_sample(rng, size):
+    """
+    random floats in [0, 1) from the generator rng, or from the global numpy random generator if rng is None
+    """
+    if rng is None:
+        return np.random.random_sample(size)
+    return rng.random(size)
+
+
+def get_moving_block_bootstrap_indices(num_dates, num_days, block_length, num_realizations, rng=None):
+    """
+    Moving block bootstrap: consecutive blocks of block_length days, with starts drawn uniformly from the days whose
+    block fits in the history (the last start is excluded, as the synthetic realizations always did).
+    The days near the ends of the history are in fewer blocks, so they are sampled less.
+    """
+    num_blocks = int(np.ceil(1.0 * num_days / block_length))
+    inds_start = get_random_integers(rng, 1, num_dates - block_length, (num_realizations, num_blocks))
+    inds_data = inds_start[:, :, None] + np.arange(block_length)[None, None, :]
+    return inds_data.reshape(num_realizations, -1)[:, 0:num_days]
+
+
+def get_circular_block_bootstrap_indices(num_dates, num_days, block_length, num_realizations, rng=None):
+    """
+    Circular block bootstrap: consecutive blocks of block_length days with starts drawn uniformly from all the days,
+    where the history is wrapped around so that every day is sampled equally.
+    """
+    num_blocks = int(np.ceil(1.0 * num_days / block_length))
+    inds_start = get_random_integers(rng, 0, num_dates - 1, (num_realizations, num_blocks))
+    inds_data = inds_start[:, :, None] + np.arange(block_length)[None, None, :]
+    return 1 + np.mod(inds_data.reshape(num_realizations, -1)[:, 0:num_days], num_dates - 1)
+
+
+def get_stationary_bootstrap_indices(num_dates, num_days, block_length, num_realizations, rng=None):
+    """
+    Stationary bootstrap (Politis & Romano): blocks of random geometric lengths with a mean of block_length days, on
+    the history wrapped around as in the circular block bootstrap. Every day starts a new block with probability
+    1 / block_length, so the synthetic series is stationary and has no seams at fixed positions.
+    """
+    is_block_start = get_random_sample(rng, (num_realizations, num_days)) < 1.0 / block_length
+    is_block_start[:, 0] = True
+    # a start of the data for each block (the blocks of all the realizations are numbered one after the other)
+    inds_start = get_random_integers(rng, 0, num_dates - 1, np.count_nonzero(is_block_start))
+    inds_block = np.cumsum(is_block_start).reshape(num_realizations, num_days) - 1
+
+    # each day continues the block of the last block start before it
+    days = np.arange(num_days)
+    days_block_start = np.maximum.accumulate(np.where(is_block_start, days[None, :], 0), axis=1)
+    inds_data = inds_start[inds_block] + days[None, :] - days_block_start
+    return 1 + np.mod(inds_data, num_dates - 1)
+
+
+def get_bootstrap_indices(bootstrap_method, num_dates, num_days, block_length, num_realizations, rng=None):
+    """
+    Rows of the market data for num_realizations synthetic realizations of num_days days, as a
+    (realizations x days) array. The rows are days 1 to num_dates - 1 (the first day has no daily return).
+    Uses the numpy Generator rng, or the global numpy random generator if rng is None.
+    """
+    if bootstrap_method == 'moving_block':
+        return get_moving_block_bootstrap_indices(num_dates, num_days, block_length, num_realizations, rng)
+    elif bootstrap_method == 'circular_block':
+        return get_circular_block_bootstrap_indices(num_dates, num_days, block_length, num_realizations, rng)
+    elif bootstrap_method == 'stationary':
+        return get_stationary_bootstrap_indices(num_dates, num_days, block_length, num_realizations, rng)
+    else:
+        raise ValueError('invalid bootstrap_method: ' + str(bootstrap_method))
+
+
+def get_root_entropy():
+    """
+    fresh entropy (a 128 bit integer from the OS) for the root of the random streams of a sweep, see
+    get_realization_seed_sequences
+    """
+    return np.random.SeedSequence().entropy
+
+
+def get_config_spawn_key(config_key):
+    """
+    Spawn key (a non-negative integer) of the random streams of a configuration of a sweep, see
+    get_realization_seed_sequences. A string key (e.g. the sim_name of the configuration) is hashed to 64 bits with
+    sha256, which is the same in every process (unlike the built-in hash).
+    """
+    if isinstance(config_key, str):
+        return int(hashlib.sha256(config_key.encode()).hexdigest()[:16], 16)
+    elif isinstance(config_key, (int, np.integer)) and config_key >= 0:
+        return int(config_key)
+    else:
+        raise ValueError('invalid config_key: ' + str(config_key))
+
+
+def get_realization_seed_sequences(root_entropy, inds_realizations, config_key=None):
+    """
+    Independent random streams of the synthetic realizations, as numpy SeedSequence objects to be used as the seed of
+    the realizations (see get_synthetic_data_indices).
+    The stream of realization r is the child (r) of the root SeedSequence(root_entropy). Without config_key all the
+    configurations of the sweep are simulated on the same paths (common random numbers), so the differences between
+    the configurations are not masked by the noise of unrelated paths.
+    A configuration with a config_key (a non-negative int, or a string such as its sim_name, see get_config_spawn_key)
+    has its own streams instead, the children (config_key, r) of the root.
+    The streams do not overlap, and realization r is the same in any shard of realizations it is simulated in, so a
+    realization can be regenerated exactly from the root entropy, the config_key and its index.
+    """
+    if config_key is None:
+        spawn_keys = [(ind_real,) for ind_real in inds_realizations]
+    else:
+        config_spawn_key = get_config_spawn_key(config_key)
+        spawn_keys = [(config_spawn_key, ind_real) for ind_real in inds_realizations]
+    return [np.random.SeedSequence(root_entropy, spawn_key=spawn_key) for spawn_key in spawn_keys]
@@ -2,10 +2,15 @@
 
 import argparse
 import ast
+import atexit
 import os
 import numpy as np
 
 from market_functions import simulate_portfolio_evolution
+from batch_market_functions import simulate_portfolio_evolution_batch
+from bootstrap_functions import get_realization_seed_sequences
+from metrics_functions import get_bootstrap_precision
+from data_functions import get_shared_market_panel_name, acquire_shared_market_panel, release_shared_market_panel
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--settings', help='settings (dict) for the portfolio simulation algorithm',
@@ -24,37 +29,129 @@ os.makedirs(bootstrap_params['save_dir'], exist_ok=True)
 log_file_path = bootstrap_params['save_dir'] + '/log_' + bootstrap_params['sim_name'] + '.txt'
 log_file = open(log_file_path, 'w')
 
+engine = bootstrap_params.get('engine', 'serial')
+if engine not in ['serial', 'batch']:
+    raise ValueError('invalid engine: ' + str(engine))
+if 'portfolio_fractions_list' in bootstrap_params and engine != 'batch':
+    raise ValueError('portfolio_fractions_list requires the batch engine, got engine = ' + str(engine))
+
+# only the final yields and risk metrics are kept, so the per-day history is not recorded
+settings['record'] = 'summary'
+
+# the slaves of a sweep on the same node share one MarketPanel of all the series of the sweep in memory (see
+# acquire_shared_market_panel): the first slave on the node prepares and publishes it, the others attach to it without
+# reading any data file. The last slave on the node to exit removes it from /dev/shm.
+if 'market_panel_name' in bootstrap_params:
+    market_panel_name = get_shared_market_panel_name(bootstrap_params['market_panel_name'],
+                                                     bootstrap_params['market_panel_stock_names'])
+    acquire_shared_market_panel(market_panel_name, bootstrap_params['market_panel_stock_names'],
+                                settings['date_start'], settings['date_end'], settings=settings)
+    atexit.register(release_shared_market_panel, market_panel_name)
+    print('attached market panel ' + market_panel_name, file=log_file)
+
+# with the root_entropy of a sweep, realization r draws from its own child stream of the root, the same in all the
+# configurations unless a config_key is given (see get_realization_seed_sequences). A shard of the realizations of
+# the sweep starts at ind_realization_first. The root entropy is recorded in the header of the result files.
+seeds = None
+results_header = ''
+if 'root_entropy' in bootstrap_params:
+    ind_realization_first = bootstrap_params.get('ind_realization_first', 0)
+    results_header = 'root_entropy = ' + str(bootstrap_params['root_entropy']) \
+                     + ', config_key = ' + str(bootstrap_params.get('config_key')) \
+                     + ', ind_realization_first = ' + str(ind_realization_first)
+    print(results_header, file=log_file)
+    seeds = get_realization_seed_sequences(bootstrap_params['root_entropy'],
+                                           range(ind_realization_first,
+                                                 ind_realization_first + bootstrap_params['num_realizations']),
+                                           config_key=bootstrap_params.get('config_key'))
+
+# with a list of portfolio fractions (batch engine only) the fraction variants are simulated together, see
+# simulate_portfolio_evolution_batch, and saved with a sim_name each
+sim_name_list = bootstrap_params.get('sim_name_list', [bootstrap_params['sim_name']])
+if engine == 'batch' and seeds is None:
+    seeds = [np.random.randint(1e6) + ind_real for ind_real in range(bootstrap_params['num_realizations'])]
+    print('seeds = ' + str(seeds), file=log_file)
+
+# adaptive number of realizations: simulate in chunks of chunk_size realizations until the confidence intervals of
+# the yield percentiles (relative width) and of p_lose are narrower than the targets, or num_realizations are done
+precision_targets = {}
+if 'percentile_ci_relative_width' in bootstrap_params:
+    for percentile in [5, 50, 95]:
+        precision_targets['percentile_ci_relative_width_' + str(percentile)] = \
+            bootstrap_params['percentile_ci_relative_width']
+if 'p_lose_ci_width' in bootstrap_params:
+    precision_targets['p_lose_ci_width'] = bootstrap_params['p_lose_ci_width']
+chunk_size = bootstrap_params.get('chunk_size', 200) if len(precision_targets) > 0 \
+    else bootstrap_params['num_realizations']
+
 # perform bootstrap loop
-yield_list = []
-yield_tax_free_list = []
-yield_min_list = []
-max_drawdown_list = []
+yield_list = [[] for _ in sim_name_list]
+yield_tax_free_list = [[] for _ in sim_name_list]
+yield_min_list = [[] for _ in sim_name_list]
+max_drawdown_list = [[] for _ in sim_name_list]
 monthly_buy_days_list = []
 monthly_sell_days_list = []
 
-for ind_real in range(bootstrap_params['num_realizations']):
-    settings['seed'] = np.random.randint(1e6) + ind_real
-    print('seed = ' + str(settings['seed']), file=log_file)
+num_realizations_done = 0
+while num_realizations_done < bootstrap_params['num_realizations']:
+    inds_real = range(num_realizations_done, min(num_realizations_done + chunk_size,
+                                                 bootstrap_params['num_realizations']))
+
+    if engine == 'batch':
+        # simulate the realizations together in chunks, see simulate_portfolio_evolution_batch
+        results = simulate_portfolio_evolution_batch(settings, [seeds[ind_real] for ind_real in inds_real],
+                                                     batch_size=bootstrap_params.get('batch_size', 1000),
+                                                     portfolio_fractions_list=bootstrap_params.get(
+                                                         'portfolio_fractions_list'))
+        if 'portfolio_fractions_list' not in bootstrap_params:
+            results = {key: values[None, :] for key, values in results.items()}
+
+        for ind_fractions in range(len(sim_name_list)):
+            yield_list[ind_fractions] += list(results['total_yield'][ind_fractions])
+            yield_tax_free_list[ind_fractions] += list(results['total_yield_tax_free'][ind_fractions])
+            yield_min_list[ind_fractions] += list(results['yield_min'][ind_fractions])
+            max_drawdown_list[ind_fractions] += list(results['max_drawdown'][ind_fractions])
+
+    else:
+        for ind_real in inds_real:
+            settings['seed'] = np.random.randint(1e6) + ind_real if seeds is None else seeds[ind_real]
+            print('seed = ' + str(settings['seed']), file=log_file)
+
+            data = simulate_portfolio_evolution(settings)
 
-    data = simulate_portfolio_evolution(settings)
+            # label = 'real ' + str(ind_real) + ', yield=' + '{:0.2f}'.format(data['total_yield'])
+            # print(label, file=log_file)
 
-    # label = 'real ' + str(ind_real) + ', yield=' + '{:0.2f}'.format(data['total_yield'])
-    # print(label, file=log_file)
+            yield_list[0] += [data['total_yield']]
+            yield_tax_free_list[0] += [data['total_yield_tax_free']]
+            yield_min_list[0] += [data['yield_min']]
+            max_drawdown_list[0] += [data['max_drawdown']]
+            monthly_buy_days_list += [data['average_monthly_buy_days']]
+            monthly_sell_days_list += [data['average_monthly_sell_days']]
 
-    yield_list += [data['total_yield']]
-    yield_tax_free_list += [data['total_yield_tax_free']]
-    yield_min_list += [data['yield_min']]
-    max_drawdown_list += [data['max_drawdown']]
-    monthly_buy_days_list += [data['average_monthly_buy_days']]
-    monthly_sell_days_list += [data['average_monthly_sell_days']]
+    num_realizations_done = inds_real[-1] + 1
 
-# results_mat = np.array([yield_list, yield_tax_free_list, yield_min_list, max_drawdown_list,
-#                         monthly_buy_days_list, monthly_sell_days_list]).T
-results_mat = np.array([yield_list, yield_tax_free_list, yield_min_list, max_drawdown_list]).T
+    # stop when the estimates of all the fraction variants are precise enough
+    if len(precision_targets) > 0:
+        is_precise = True
+        for sim_name, yield_list_fractions in zip(sim_name_list, yield_list):
+            precision = get_bootstrap_precision(yield_list_fractions,
+                                                confidence_level_percents=bootstrap_params.get(
+                                                    'confidence_level_percents', 95))
+            print('realizations ' + str(num_realizations_done) + ', ' + sim_name + ', '
+                  + ', '.join([key + ' = ' + '{:0.4f}'.format(value) for key, value in precision.items()]), file=log_file)
+            is_precise &= all([precision[key] <= target for key, target in precision_targets.items()])
+        if is_precise:
+            break
 
 # save results to file
-save_file_path = bootstrap_params['save_dir'] + '/' + bootstrap_params['sim_name'] + '.txt'
-# np.savetxt(save_file_path, yield_list)
-np.savetxt(save_file_path, results_mat)
+for ind_fractions, sim_name in enumerate(sim_name_list):
+    # results_mat = np.array([yield_list, yield_tax_free_list, yield_min_list, max_drawdown_list,
+    #                         monthly_buy_days_list, monthly_sell_days_list]).T
+    results_mat = np.array([yield_list[ind_fractions], yield_tax_free_list[ind_fractions],
+                            yield_min_list[ind_fractions], max_drawdown_list[ind_fractions]]).T
+    save_file_path = bootstrap_params['save_dir'] + '/' + sim_name + '.txt'
+    # np.savetxt(save_file_path, yield_list)
+    np.savetxt(save_file_path, results_mat, header=results_header)
 
-log_file.close()
\ No newline at end of file
+log_file.close()
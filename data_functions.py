@@ -1,10 +1,16 @@
 import pandas as pd
 import numpy as np
-import copy
-from scipy.interpolate import interp1d
-from aux_functions import change_date_format_investingcom_to_yahoo, get_number_of_days_between_dates, \
-    transform_to_days_array, get_inds_between_dates, get_index_of_date
+from aux_functions import change_date_format_investingcom_to_yahoo, get_year_labels, get_date_ordinals, \
+    get_days_array, DateIndex
 import os
+import re
+import json
+import csv
+import io
+import hashlib
+import tempfile
+import time
+import warnings
 
 
 def define_stock_parameters():
@@ -185,14 +191,407 @@ def define_stock_parameters():
     return expense_ratios, leverage_factors, underlying_index, dividend_yield
 
 
-def load_stock_data(stock_name, date_start=None, date_end=None, normalize=True, close_type='Close',
-                    data_format='Yahoo', dividend_yield=None, settings=None):
+def define_dividend_models():
     """
-    Load stock time evolution data.
-    If date for start/end is given, restrict the output by those dates.
-    Most data is from Yahoo finance.
+    Dividend model of each stock. 'constant' stocks pay their constant dividend_yield, while for 'libor' stocks
+    a phenomenological model treats the time varying dividend of bonds: dividend_yield + 0.5 * libor rate.
+    """
+    dividend_models = {}
+    dividend_models['VUSTX'] = 'libor'
+    dividend_models['TLT'] = 'libor'
+    return dividend_models
+
+
+def get_total_return_index(index_name):
+    """
+    the series that includes the dividends of an index, used for the underlying of leveraged etfs
+    """
+    total_return_indices = {'SP500': 'SP500TR', 'NDX100': 'NDX100TR', 'VUSTX': 'VUSTX-TR', 'TLT': 'TLT-TR'}
+    if index_name in total_return_indices:
+        return total_return_indices[index_name]
+    return index_name
+
+
+instrument_dtype = np.dtype([('name', 'U32'),
+                             ('expense_ratio', np.float64),  # [percents]
+                             ('leverage_factor', np.float64),
+                             ('underlying_index', 'U32'),
+                             ('dividend_yield', np.float64),  # [percents]
+                             ('dividend_model', 'U16')])
+
+
+class InstrumentRegistry:
+    """
+    Parameters of all the known stocks, held as a structured array with one record per stock.
+    Leveraged variants that are not hard-coded in define_stock_parameters can be requested by a name of the form
+    <stock_name>x<leverage>, e.g. 'VOOx2.5' or 'VUSTXx3', and are registered on first request.
+    """
+
+    def __init__(self):
+        expense_ratios, leverage_factors, underlying_index, dividend_yield = define_stock_parameters()
+        dividend_models = define_dividend_models()
+        stock_names = list(expense_ratios.keys())
+        self.instruments = np.zeros(len(stock_names), dtype=instrument_dtype)
+        for i, stock_name in enumerate(stock_names):
+            self.instruments[i] = (stock_name, expense_ratios[stock_name], leverage_factors[stock_name],
+                                   underlying_index[stock_name], dividend_yield[stock_name],
+                                   dividend_models.get(stock_name, 'constant'))
+        self.rows = {stock_name: i for i, stock_name in enumerate(stock_names)}
+
+    def __contains__(self, stock_name):
+        return stock_name in self.rows
+
+    def get_instrument(self, stock_name):
+        if stock_name not in self.rows:
+            self.add_leveraged_instrument(stock_name)
+        return self.instruments[self.rows[stock_name]]
+
+    def add_leveraged_instrument(self, stock_name):
+        """
+        register a fictitious leveraged etf named <stock_name>x<leverage>, tracking the total-return series of the
+        underlying of stock_name, with the 1% expense ratio assumed for all the fictitious etfs
+        """
+        match = re.fullmatch(r'(.+)x([0-9]*\.?[0-9]+)', stock_name)
+        if match is None or match.group(1) not in self.rows:
+            raise ValueError('unknown stock_name: ' + str(stock_name))
+        base_instrument = self.instruments[self.rows[match.group(1)]]
+        underlying_index = get_total_return_index(base_instrument['underlying_index'])
+        if base_instrument['dividend_yield'] > 0 and underlying_index == base_instrument['underlying_index']:
+            raise ValueError('no total-return series to leverage ' + str(match.group(1)) + ' with its dividends.')
+        instrument = np.array([(stock_name, 1.0, base_instrument['leverage_factor'] * float(match.group(2)),
+                                underlying_index, 0, 'constant')], dtype=instrument_dtype)
+        self.instruments = np.concatenate([self.instruments, instrument])
+        self.rows[stock_name] = len(self.instruments) - 1
+
+    def get_stock_parameters(self, stock_names=None):
+        """
+        the parameters of stock_names (all registered stocks by default) in the format of define_stock_parameters
+        """
+        if stock_names is None:
+            stock_names = list(self.rows.keys())
+        expense_ratios, leverage_factors, underlying_index, dividend_yield = {}, {}, {}, {}
+        for stock_name in stock_names:
+            instrument = self.get_instrument(stock_name)
+            expense_ratios[stock_name] = float(instrument['expense_ratio'])
+            leverage_factors[stock_name] = float(instrument['leverage_factor'])
+            underlying_index[stock_name] = str(instrument['underlying_index'])
+            dividend_yield[stock_name] = float(instrument['dividend_yield'])
+        return expense_ratios, leverage_factors, underlying_index, dividend_yield
+
+    def get_dividend_models(self, stock_names):
+        return {stock_name: str(self.get_instrument(stock_name)['dividend_model']) for stock_name in stock_names}
+
+
+def get_daily_factors(instrument, returns, libor_rate, num_trading_days_in_year):
+    """
+    Daily factor of the value of a stock, given the daily returns of its underlying index.
+    The leveraged change is reduced by the daily cut of the expense-ratio and of the loan-rate (LIBOR) on the
+    borrowed part, and a paper can not lose more than its entire value.
+    """
+    stock_change_percents = 100 * (np.asarray(returns) - 1)
+    leverage_change_percents = instrument['leverage_factor'] * stock_change_percents
+    expense_ratio_daily_percents = instrument['expense_ratio'] / num_trading_days_in_year
+    libor_rate_daily_percents = (instrument['leverage_factor'] - 1) * np.asarray(libor_rate) \
+                                / num_trading_days_in_year
+    paper_change_percents = leverage_change_percents - expense_ratio_daily_percents - libor_rate_daily_percents
+    paper_change_percents = np.maximum(paper_change_percents, -100)  # deal with case of total paper value loss
+    return 1 + paper_change_percents / 100.0
+
+
+def get_dividend_fractions(instrument, libor_rate, num_trading_days_in_year):
+    """
+    Daily dividend of a stock as a fraction of its value, we assume the dividends are given on a daily basis for
+    simplicity. For the 'libor' dividend model (bonds) the dividend yield varies in time with the loan-rate (LIBOR).
+    """
+    libor_rate = np.asarray(libor_rate)
+    if instrument['dividend_model'] == 'libor':
+        dividend_yield = float(instrument['dividend_yield']) + 0.5 * libor_rate
+    else:
+        dividend_yield = np.full(libor_rate.shape, float(instrument['dividend_yield']))
+    return dividend_yield / 100.0 / num_trading_days_in_year
+
+
+def get_data_file_path(data_file_name):
+    main_dir = os.path.dirname(os.path.abspath(__file__))
+    return main_dir + '/data/' + data_file_name + '.csv'
+
+
+def get_cache_dir(data_file_name):
+    main_dir = os.path.dirname(os.path.abspath(__file__))
+    return main_dir + '/data/cache/' + data_file_name
+
+
+def get_cached_columns(data_format):
+    """
+    The price columns that are kept in the binary cache for each data format
+    """
+    if data_format == 'Yahoo':
+        return ['Open', 'High', 'Low', 'Close', 'Adj Close']
+    elif data_format == 'Investing.com':
+        return ['Price', 'Open', 'High', 'Low']
+    else:
+        raise ValueError('invalid data_format = ' + str(data_format))
+
+
+def get_data_format(data_file_name):
+    """
+    Yahoo or Investing.com, detected from the header line of the csv data file
+    """
+    with open(get_data_file_path(data_file_name), 'r', encoding='utf-8-sig') as f:
+        header_line = f.readline()
+    if 'Adj Close' in header_line:
+        return 'Yahoo'
+    elif 'Price' in header_line:
+        return 'Investing.com'
+    else:
+        raise ValueError('unknown data format of data file ' + str(data_file_name))
+
+
+def parse_data_frame(data, data_format='Yahoo'):
+    """
+    Parse the rows of a csv data file (as a DataFrame) into day ordinals (days since 1970-01-01) and float64 price
+    columns, ordered from past to future.
+    """
+    columns = {}
+    if data_format == 'Yahoo':
+        days = np.array(data['Date'], dtype='datetime64[D]').astype(np.int32)
+        for column in get_cached_columns(data_format):
+            columns[column] = np.array(data[column], dtype=np.float64)
+    elif data_format == 'Investing.com':
+        dates = [change_date_format_investingcom_to_yahoo(x) for x in data['Date']]
+        days = np.array(dates, dtype='datetime64[D]').astype(np.int32)
+        for column in get_cached_columns(data_format):
+            columns[column] = np.array([float(str(x).replace(',', '')) for x in data[column]], dtype=np.float64)
+        # date is "future to past" so reverse it
+        days = days[::-1].copy()
+        for column in columns:
+            columns[column] = columns[column][::-1].copy()
+    else:
+        raise ValueError('invalid data_format = ' + str(data_format))
+    return days, columns
+
+
+def parse_data_file(data_file_name, data_format='Yahoo'):
+    """
+    Parse a csv data file into day ordinals (days since 1970-01-01) and float64 price columns,
+    ordered from past to future.
+    """
+    data = pd.read_csv(get_data_file_path(data_file_name))
+    return parse_data_frame(data, data_format=data_format)
+
+
+def get_source_signature(data_file_name):
+    """
+    mtime and size of the csv file, used to invalidate the binary cache when the source changes
+    """
+    stat = os.stat(get_data_file_path(data_file_name))
+    return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+
+def save_array_to_cache(file_path, array):
+    # write to a temporary file first, so parallel jobs never read a partially written cache file
+    tmp_file_path = file_path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_file_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_file_path, file_path)
+
+
+def get_data_version(cache_name):
+    """
+    data version number of the binary cache, incremented whenever the cached arrays are rebuilt or appended to
+    (0 if there is no cache)
+    """
+    version_file_path = get_cache_dir(cache_name) + '/version.npy'
+    if not os.path.isfile(version_file_path):
+        return 0
+    return int(np.load(version_file_path))
+
+
+def load_cached_arrays(cache_name, signature, array_names, build_arrays):
+    """
+    Load named arrays from the binary cache under data/cache, memory mapped.
+    If the cache is missing or its signature differs from the given one, the arrays are rebuilt with build_arrays()
+    and saved to the cache.
+    """
+    cache_dir = get_cache_dir(cache_name)
+
+    cache_is_valid = False
+    if os.path.isfile(cache_dir + '/source.npy'):
+        cache_is_valid = np.array_equal(np.load(cache_dir + '/source.npy'), signature)
+
+    if not cache_is_valid:
+        arrays = build_arrays()
+        os.makedirs(cache_dir, exist_ok=True)
+        for array_name in array_names:
+            save_array_to_cache(cache_dir + '/' + array_name + '.npy', arrays[array_name])
+        save_array_to_cache(cache_dir + '/version.npy', np.array(get_data_version(cache_name) + 1, dtype=np.int64))
+        # the signature is written last, marking the cache as complete
+        save_array_to_cache(cache_dir + '/source.npy', signature)
+
+    arrays = {}
+    for array_name in array_names:
+        arrays[array_name] = np.load(cache_dir + '/' + array_name + '.npy', mmap_mode='r')
+    return arrays
+
+
+def load_data_file(data_file_name, data_format='Yahoo'):
+    """
+    Load the parsed columns of a csv data file from the binary cache, memory mapped.
+    The cache is (re)built from the csv if it is missing or if the csv mtime/size changed.
+    """
+    def build_arrays():
+        days, columns = parse_data_file(data_file_name, data_format=data_format)
+        columns['days'] = days
+        return columns
+
+    columns = load_cached_arrays(data_file_name, get_source_signature(data_file_name),
+                                 ['days'] + get_cached_columns(data_format), build_arrays)
+    days = columns.pop('days')
+    return days, columns
+
+
+def read_appended_rows(data_file_name, data_format, num_bytes_cached, last_day):
+    """
+    Read only the rows that were added to a csv data file after it was cached, without parsing the rest of the file.
+    Yahoo files grow at the tail, so the rows after the first num_bytes_cached bytes are read.
+    Investing.com files are ordered "future to past" and grow at the head, so rows are read from the head until the
+    row of last_day (the last cached day).
+    Returns the header line, the cached row at the join point and the new rows, as csv text.
+    """
+    with open(get_data_file_path(data_file_name), 'rb') as f:
+        header_line = f.readline().decode('utf-8-sig')
+        if data_format == 'Yahoo':
+            # the last cached row ends at num_bytes_cached
+            chunk_start = max(f.tell(), num_bytes_cached - 4096)
+            f.seek(chunk_start)
+            chunk = f.read(num_bytes_cached - chunk_start).decode()
+            join_row = chunk.rstrip('\r\n').rsplit('\n', 1)[-1] + '\n'
+            new_rows = [row + '\n' for row in f.read().decode().splitlines() if len(row.strip()) > 0]
+        elif data_format == 'Investing.com':
+            join_row = None
+            new_rows = []
+            for line in f:
+                row = line.decode()
+                date = change_date_format_investingcom_to_yahoo(next(csv.reader([row]))[0])
+                if get_date_ordinals(date) <= last_day:
+                    join_row = row
+                    break
+                new_rows.append(row)
+            if join_row is None:
+                raise ValueError('last cached day not found in data file ' + str(data_file_name))
+        else:
+            raise ValueError('invalid data_format = ' + str(data_format))
+    return header_line, join_row, new_rows
+
+
+def ingest_data_file(data_file_name, data_format=None):
+    """
+    Append the rows that were added to a csv data file to its binary cache, without re-parsing the whole file.
+    Only the cache is appended to: memoized results that depend on the file are rebuilt from the cache by the market
+    data store (see MarketDataStore.ingest_data_file), and published panels are not updated.
+    The cached row at the join point must be unchanged and the new rows must continue after the last cached day,
+    otherwise a ValueError is raised (delete the cache directory to rebuild it from scratch).
+    If there is no valid-looking cache, it is built from the full file.
+    Returns the data version of the cache, the number of appended rows and the last day (ordinal) cached before.
     """
+    if data_format is None:
+        data_format = get_data_format(data_file_name)
+    cache_dir = get_cache_dir(data_file_name)
+    array_names = ['days'] + get_cached_columns(data_format)
+    signature = get_source_signature(data_file_name)
+
+    if not os.path.isfile(cache_dir + '/source.npy'):
+        days, _ = load_data_file(data_file_name, data_format=data_format)
+        return get_data_version(data_file_name), len(days), None
+    cached_signature = np.load(cache_dir + '/source.npy')
+    arrays = {array_name: np.load(cache_dir + '/' + array_name + '.npy', mmap_mode='r')
+              for array_name in array_names}
+    last_day = int(arrays['days'][-1])
+    if np.array_equal(cached_signature, signature):
+        return get_data_version(data_file_name), 0, last_day
+    num_bytes_cached = int(cached_signature[1])
+    if signature[1] <= num_bytes_cached:
+        raise ValueError('data file ' + str(data_file_name) + ' did not grow since it was cached')
+
+    header_line, join_row, new_rows = read_appended_rows(data_file_name, data_format, num_bytes_cached, last_day)
+
+    # validate continuity at the join point
+    join_days, join_columns = parse_data_frame(pd.read_csv(io.StringIO(header_line + join_row)), data_format)
+    if join_days[0] != last_day or any(join_columns[column][0] != arrays[column][-1] for column in join_columns):
+        raise ValueError('data file ' + str(data_file_name) + ' does not match its cache at the join point '
+                         + str(np.datetime64(last_day, 'D')))
+    if len(new_rows) == 0:
+        save_array_to_cache(cache_dir + '/source.npy', signature)
+        return get_data_version(data_file_name), 0, last_day
+    new_days, new_columns = parse_data_frame(pd.read_csv(io.StringIO(header_line + ''.join(new_rows))), data_format)
+    new_columns['days'] = new_days
+    if new_days[0] <= last_day or np.any(np.diff(new_days) <= 0):
+        raise ValueError('appended rows of data file ' + str(data_file_name) + ' do not continue after '
+                         + str(np.datetime64(last_day, 'D')))
+
+    for array_name in array_names:
+        save_array_to_cache(cache_dir + '/' + array_name + '.npy',
+                            np.concatenate([arrays[array_name], new_columns[array_name]]))
+    version = get_data_version(data_file_name) + 1
+    save_array_to_cache(cache_dir + '/version.npy', np.array(version, dtype=np.int64))
+    # the signature is written last, marking the cache as complete
+    save_array_to_cache(cache_dir + '/source.npy', signature)
+    return version, len(new_days), last_day
+
+
+def stitch_NDX100TR_data(days_NDX100, values_NDX100, days_NDX100TR, values_NDX100TR, dividend_yield_NDX100,
+                         num_trading_days_in_year):
+    """
+    Artificially extend NDX100TR data prior to 1999 by stitching it with NDX100 data + estimated dividends.
+    The NDX100 trading dates are used as the dates axis, so the NDX100TR daily changes are matched by position.
+    """
+    inds = np.arange(1, len(days_NDX100) - 1)
+    inds = inds[days_NDX100[inds] <= days_NDX100TR[-1]]
+
+    # use the NDX100 + dividends prior to 1999
+    inds_before_NDX100TR = inds[days_NDX100[inds] <= days_NDX100TR[0]]
+    factors_before_NDX100TR = values_NDX100[inds_before_NDX100TR] / values_NDX100[inds_before_NDX100TR - 1] \
+                              * (1 + dividend_yield_NDX100 / 100.0 / num_trading_days_in_year)
 
+    # use the NDX100TR data after 1999
+    num_days_NDX100TR = len(inds) - len(inds_before_NDX100TR)
+    if num_days_NDX100TR > len(values_NDX100TR) - 1:
+        raise ValueError('NDX100 has more trading dates than NDX100TR in the overlapping period.')
+    factors_NDX100TR = values_NDX100TR[1:num_days_NDX100TR + 1] / values_NDX100TR[:num_days_NDX100TR]
+
+    values = np.cumprod(np.concatenate([[1.0], factors_before_NDX100TR, factors_NDX100TR]))
+    days = np.array(days_NDX100[:len(values)])
+    return days, values
+
+
+def load_NDX100TR_data(dividend_yield_NDX100, num_trading_days_in_year):
+    """
+    The stitched NDX100TR series, kept in the binary cache per dividend yield and number of trading days.
+    Rebuilt if one of the source csv files changed.
+    """
+    # date from https://www.investing.com/indices/nasdaq-100-tr-historical-data
+    data_file_name_NDX100TR = 'Nasdaq 100 TR Historical Data'
+    data_file_name_NDX100 = '^NDX'
+
+    def build_arrays():
+        days_NDX100, columns_NDX100 = load_data_file(data_file_name_NDX100, data_format='Yahoo')
+        days_NDX100TR, columns_NDX100TR = load_data_file(data_file_name_NDX100TR, data_format='Investing.com')
+        days, values = stitch_NDX100TR_data(days_NDX100, columns_NDX100['Close'], days_NDX100TR,
+                                            columns_NDX100TR['Price'], dividend_yield_NDX100,
+                                            num_trading_days_in_year)
+        return {'days': days, 'Close': values}
+
+    cache_name = 'NDX100TR_div_' + str(dividend_yield_NDX100) + '_days_' + str(num_trading_days_in_year)
+    signature = np.concatenate([get_source_signature(data_file_name_NDX100),
+                                get_source_signature(data_file_name_NDX100TR)])
+    arrays = load_cached_arrays(cache_name, signature, ['days', 'Close'], build_arrays)
+    return arrays['days'], arrays['Close']
+
+
+def get_data_file_name(stock_name, close_type='Close'):
+    """
+    the csv data file and close type of the series of stock_name
+    """
     data_file_name = stock_name
     if stock_name == 'SP500':
         data_file_name = '^GSPC'
@@ -206,67 +605,55 @@ def load_stock_data(stock_name, date_start=None, date_end=None, normalize=True,
     elif stock_name == 'VUSTX-TR':
         data_file_name = 'VUSTX'
         close_type = 'Adj Close'
-    elif stock_name == 'NDX100TR':
-        # date from https://www.investing.com/indices/nasdaq-100-tr-historical-data
-        data_file_name = 'Nasdaq 100 TR Historical Data'
-        data_format = 'Investing.com'
+    return data_file_name, close_type
 
-    main_dir = os.path.dirname(os.path.abspath(__file__))
-    data = pd.read_csv(main_dir + '/data/' + data_file_name + '.csv')
 
-    if data_format == 'Yahoo':
-        dates = [x for x in data['Date']]
-        values = np.array([x for x in data[close_type]])
-    elif data_format == 'Investing.com':
-        # special treatment for NDX100TR
-        dates = [change_date_format_investingcom_to_yahoo(x) for x in data['Date']]
-        values = np.array([float(x.replace(',', '')) for x in data['Price']])
-        # date is "future to past" so reverse it
-        dates = dates[::-1]
-        values = values[::-1]
-    else:
-        raise ValueError('invalid data_format = ' + str(data_format))
+def get_source_data_file_names(stock_name):
+    """
+    all the csv data files that the series of stock_name is built from
+    """
+    if stock_name == 'NDX100TR':
+        return ['^NDX', 'Nasdaq 100 TR Historical Data']
+    return [get_data_file_name(stock_name)[0]]
+
+
+def load_stock_data(stock_name, date_start=None, date_end=None, normalize=True, close_type='Close',
+                    data_format='Yahoo', dividend_yield=None, settings=None):
+    """
+    Load stock time evolution data.
+    If date for start/end is given, restrict the output by those dates.
+    Most data is from Yahoo finance.
+    """
+
+    data_file_name, close_type = get_data_file_name(stock_name, close_type)
 
-    # artificially extend NDX100TR data prior to 1999 by stitching it with NDX100 data + estimated dividends
     if stock_name == 'NDX100TR':
-        dates_NDX100, values_NDX100 = load_stock_data('NDX100', date_start=None, date_end=None,
-                                                      normalize=normalize, close_type=close_type, data_format='Yahoo',
-                                                      dividend_yield=dividend_yield, settings=settings)
-
-        data_start_NDX100TR = dates[0]
-        data_end_NDX100TR = dates[-1]
-        ind_cnt_NDX100TR = 1
-        values_merged = [1.0]
-        for i in range(1, len(dates_NDX100) - 1):
-            curr_date = dates_NDX100[i]
-            if get_number_of_days_between_dates(curr_date, data_start_NDX100TR) <= 0:
-                # use the NDX100 + dividends prior to 1999
-                values_merged += [values_merged[-1] * values_NDX100[i] / values_NDX100[i - 1]]
-                values_merged[-1] *= 1 + dividend_yield['NDX100'] / 100.0 / settings['num_trading_days_in_year']
-            elif get_number_of_days_between_dates(curr_date, data_end_NDX100TR) <= 0:
-                # use the NDX100TR data after 1999
-                values_merged += [values_merged[-1] * values[ind_cnt_NDX100TR] / values[ind_cnt_NDX100TR - 1]]
-                ind_cnt_NDX100TR += 1
-            else:
-                break
-
-        values = values_merged
-        dates = dates_NDX100
+        # NDX100TR data prior to 1999 is stitched with NDX100 data + estimated dividends
+        days, values = load_NDX100TR_data(dividend_yield['NDX100'], settings['num_trading_days_in_year'])
+    else:
+        days, columns = load_data_file(data_file_name, data_format=data_format)
+        if data_format == 'Yahoo':
+            if close_type not in columns:
+                raise ValueError('invalid close_type = ' + str(close_type))
+            values = columns[close_type]
+        else:
+            values = columns['Price']
+    date_index = DateIndex(days)
 
     # check if requested time interval is contained within the data
     if date_start is not None:
-        if get_number_of_days_between_dates(dates[0], date_start) > 0:
-            raise ValueError('data for stock ' + str(stock_name) + ' begins at ' + dates[0]
+        if date_index.ordinals[0] > get_date_ordinals(date_start):
+            raise ValueError('data for stock ' + str(stock_name) + ' begins at ' + date_index[0:1].get_dates()[0]
                              + ', but requested date_start is ' + str(date_start))
     if date_end is not None:
-        if get_number_of_days_between_dates(dates[-1], date_end) < 0:
-            raise ValueError('data for stock ' + str(stock_name) + ' ends at ' + dates[-1]
+        if date_index.ordinals[-1] < get_date_ordinals(date_end):
+            raise ValueError('data for stock ' + str(stock_name) + ' ends at ' + date_index[-1:].get_dates()[0]
                              + ', but requested date_end is ' + str(date_end))
 
     # pick only a specific time interval
-    inds_restricted = get_inds_between_dates(dates, date_start, date_end)
-    dates = [dates[i] for i in inds_restricted]
-    values = [values[i] for i in inds_restricted]
+    inds_restricted = date_index.get_slice_between_dates(date_start, date_end)
+    dates = date_index[inds_restricted].get_dates()
+    values = np.array(values[inds_restricted])
 
     # normalize to initial date
     if normalize:
@@ -275,60 +662,493 @@ def load_stock_data(stock_name, date_start=None, date_end=None, normalize=True,
     return dates, values
 
 
-def load_dividend_data(index_name='SP500'):
-    if index_name == 'NDX100':
+def load_rate_series(series_name):
+    """
+    Parse a macro series csv into a DateIndex and a values array, ordered from past to future.
+    series_name is 'libor' (1-month libor rate) or 'dividend_yield_<index_name>' for the SP500, NDX100 indices.
+    """
+    if series_name == 'libor':
+        # data from https://www.macrotrends.net/1433/historical-libor-rates-chart
+        data = pd.read_csv(get_data_file_path('historical-libor-rates-chart'))
+        dates, values = data['date'], data['libor-1-month']
+    elif series_name == 'dividend_yield_NDX100':
         # data from https://cdn.betashares.com.au/wp-content/uploads/2016/12/05160625/BetaShares-NASDAQ-100-ETF-NDQ-Whitepaper.pdf
-        data_file_name = 'historic_div_yield_NDX100'
-    elif index_name == 'SP500':
+        data = pd.read_csv(get_data_file_path('historic_div_yield_NDX100'))
+        dates, values = data['Date'], data['Value']
+    elif series_name == 'dividend_yield_SP500':
         # data from https://www.quandl.com/data/MULTPL/SP500_DIV_YIELD_MONTH-S-P-500-Dividend-Yield-by-Month
-        data_file_name = 'historic_div_yield_SP500'
+        data = pd.read_csv(get_data_file_path('historic_div_yield_SP500'))
+        dates, values = data['Date'], data['Value']
     else:
+        raise ValueError('invalid series_name: ' + str(series_name))
+    ordinals = get_date_ordinals(np.array(dates, dtype=str))
+    values = np.array(values, dtype=np.float64)
+    # some series (e.g. div yields of SP500) are given from future to past
+    inds_sorted = np.argsort(ordinals, kind='stable')
+    values = values[inds_sorted]
+    values.setflags(write=False)
+    return DateIndex(ordinals[inds_sorted]), values
+
+
+def interpolate_rate_series(series_name, dates_to_interpolate, data_store=None):
+    """
+    Linear interpolation of a macro series to the given dates, with np.interp on the day counts of the dates.
+    The series is loaded once per process by the market data store.
+    """
+    if data_store is None:
+        data_store = market_data_store
+    date_index_data, values_data = data_store.get_rate_series(series_name)
+    ordinals = get_date_ordinals(dates_to_interpolate)
+
+    # check if requested time interval is contained within the data
+    if date_index_data.ordinals[0] > ordinals[0]:
+        raise ValueError('data for ' + series_name + ' begins at ' + date_index_data[0:1].get_dates()[0]
+                         + ', but requested date_start is ' + DateIndex(ordinals[:1]).get_dates()[0])
+    if date_index_data.ordinals[-1] < ordinals[-1]:
+        raise ValueError('data for ' + series_name + ' ends at ' + date_index_data[-1:].get_dates()[0]
+                         + ', but requested date_end is ' + DateIndex(ordinals[-1:]).get_dates()[0])
+
+    days_to_interpolate = get_days_array(ordinals, ordinals[0])
+    days_data_array = date_index_data.get_days_array(date_reference=ordinals[0])
+    return np.interp(days_to_interpolate, days_data_array, values_data)
+
+
+def load_dividend_data(index_name='SP500'):
+    if index_name not in ['SP500', 'NDX100']:
         raise ValueError('invalid index_name.')
-    data = pd.read_csv('data/' + data_file_name + '.csv')
-    dates = [x for x in data['Date']]
-    dividends = [x for x in data['Value']]
-    if index_name == 'SP500':
-        # reverse the direction because div yields of SP500 are given from future to past
-        dates.reverse()
-        dividends.reverse()
-    return dates, dividends
+    date_index, dividends = market_data_store.get_rate_series('dividend_yield_' + index_name)
+    return date_index.get_dates(), list(dividends)
 
 
 def get_dividend_yield(dates_to_interpolate, index_name='SP500'):
-    dates_data, dividends_data = load_dividend_data(index_name=index_name)
-    days_to_interpolate = transform_to_days_array(dates_to_interpolate)
-    days_data_array = transform_to_days_array(dates_data, date_reference=dates_to_interpolate[0])
-    interp_fun = interp1d(days_data_array, dividends_data)
-    dividends_interpolated = interp_fun(days_to_interpolate)
-    return dividends_interpolated
+    if index_name not in ['SP500', 'NDX100']:
+        raise ValueError('invalid index_name.')
+    return interpolate_rate_series('dividend_yield_' + index_name, dates_to_interpolate)
 
 
 def load_libor_rates():
-    # data from https://www.macrotrends.net/1433/historical-libor-rates-chart
-    main_dir = os.path.dirname(os.path.abspath(__file__))
-    loan_rates_data = pd.read_csv(main_dir + '/data/historical-libor-rates-chart.csv')
-    dates = [x for x in loan_rates_data['date']]
-    libor_rate = [x for x in loan_rates_data['libor-1-month']]
-    return dates, libor_rate
+    date_index, libor_rate = market_data_store.get_rate_series('libor')
+    return date_index.get_dates(), list(libor_rate)
 
 
 def get_libor_rate(dates_to_interpolate):
-    dates_data, libor_rate_data = load_libor_rates()
-    days_to_interpolate = transform_to_days_array(dates_to_interpolate)
-    days_data_array = transform_to_days_array(dates_data, date_reference=dates_to_interpolate[0])
+    return interpolate_rate_series('libor', dates_to_interpolate)
 
-    # check if requested time interval is contained within the data
-    date_start = dates_to_interpolate[0]
-    if get_number_of_days_between_dates(dates_data[0], date_start) > 0:
-        raise ValueError('data for libor rates begins at ' + dates_data[0]
-                         + ', but requested date_start is ' + str(date_start))
-
-    date_end = dates_to_interpolate[-1]
-    if get_number_of_days_between_dates(dates_data[-1], date_end) < 0:
-        raise ValueError('data for  libor rate ends at ' + dates_data[-1]
-                         + ', but requested date_end is ' + str(date_end))
-
-    # interpolate
-    interp_fun = interp1d(days_data_array, libor_rate_data)
-    libor_rate_interpolated = interp_fun(days_to_interpolate)
-    return libor_rate_interpolated
+
+def align_to_dates_axis(date_index, dates_axis, values, fill_method='ffill'):
+    """
+    Align values sampled on date_index to the dates of dates_axis (both DateIndex).
+    Dates of the axis that are missing in date_index are returned, and forward-filled if fill_method='ffill' (otherwise an
+    error is raised).
+    """
+    inds = np.searchsorted(date_index.ordinals, dates_axis.ordinals, side='right') - 1
+    if inds[0] < 0:
+        raise ValueError('data begins after the start of the dates axis.')
+    is_missing = date_index.ordinals[inds] != dates_axis.ordinals
+    missing_dates = dates_axis.ordinals[is_missing]
+    if len(missing_dates) > 0 and fill_method != 'ffill':
+        raise ValueError(str(len(missing_dates)) + ' dates of the dates axis are missing in the data, first is '
+                         + dates_axis[np.nonzero(is_missing)[0][:1]].get_dates()[0])
+    return values[inds], missing_dates
+
+
+class MarketPanel:
+    """
+    Daily gross returns of several series on a mutual dates axis, as a (days x series) matrix.
+    Row i holds the change of each series from day i-1 to day i (row 0 is ones), so a day is a contiguous row.
+    The libor rate is kept on the same dates axis. Synthetic panels have no dates axis (date_index is None).
+    """
+
+    def __init__(self, date_index, stock_names, returns, libor_rate, missing_dates=None):
+        self.date_index = date_index
+        self.stock_names = list(stock_names)
+        self.columns = {stock_name: i for i, stock_name in enumerate(self.stock_names)}
+        self.returns = returns
+        self.libor_rate = libor_rate
+        self.missing_dates = missing_dates if missing_dates is not None else {}
+        self.dividend_yields = {}
+        self.window = None  # (date_start, date_end, num_trading_days_in_year) of panels memoized by the store
+
+    def __len__(self):
+        return self.returns.shape[0]
+
+    def get_returns(self, stock_name):
+        return self.returns[:, self.columns[stock_name]]
+
+    def get_dividend_yield(self, index_name):
+        """
+        historic dividend yield of an index on the dates axis, computed on first request
+        """
+        if index_name not in self.dividend_yields:
+            dividend_yield = interpolate_rate_series('dividend_yield_' + index_name, self.date_index)
+            dividend_yield.setflags(write=False)
+            self.dividend_yields[index_name] = dividend_yield
+        return self.dividend_yields[index_name]
+
+
+def build_market_panel(stock_names, date_start, date_end, settings=None, data_store=None, fill_method='ffill'):
+    """
+    Join the series of stock_names to the mutual dates axis of the time window and convert them to daily returns.
+    The dates that each series is missing are kept in the missing_dates of the panel, and a warning is issued for every
+    series that was forward-filled.
+    """
+    if data_store is None:
+        data_store = market_data_store
+    date_index = DateIndex(data_store.get_dates(date_start, date_end))
+
+    returns = np.ones((len(date_index), len(stock_names)))
+    missing_dates = {}
+    for i, stock_name in enumerate(stock_names):
+        dates, values = data_store.get_stock_data(stock_name, date_start, date_end, settings=settings)
+        values, missing_dates[stock_name] = align_to_dates_axis(DateIndex(dates), date_index, values,
+                                                                fill_method=fill_method)
+        if len(missing_dates[stock_name]) > 0:
+            warnings.warn(stock_name + ': ' + str(len(missing_dates[stock_name]))
+                          + ' missing dates forward-filled, first is '
+                          + DateIndex(missing_dates[stock_name][:1]).get_dates()[0])
+        returns[1:, i] = values[1:] / values[:-1]
+    returns.setflags(write=False)
+
+    libor_rate = data_store.get_libor_rate(date_start, date_end)
+    return MarketPanel(date_index, stock_names, returns, libor_rate, missing_dates=missing_dates)
+
+
+class MarketDataStore:
+    """
+    Process-wide memo of the market data needed by the simulation.
+    Stock series are memoized per (stock_name, date_start, date_end, close_type), so repeated simulations over the
+    same time window (e.g. bootstrap realizations) load each series once per process.
+    The returned arrays are read-only since they are shared between all callers.
+    """
+
+    def __init__(self):
+        self.instrument_registry = InstrumentRegistry()
+        self.stock_data = {}
+        self.dates = {}
+        self.year_labels = {}
+        self.market_panels = {}
+        self.daily_factors = {}
+        self.dividend_fractions = {}
+        self.rate_series = {}
+        self.interpolated_rates = {}
+
+    def clear(self):
+        self.__init__()
+
+    def get_stock_parameters(self, stock_names=None):
+        return self.instrument_registry.get_stock_parameters(stock_names)
+
+    def ingest_data_file(self, data_file_name, data_format=None):
+        """
+        Append the new rows of a csv data file to its binary cache (see ingest_data_file) and drop only the memoized
+        results that depend on the file and whose time window reaches past the previously cached last day.
+        Results of closed time windows, or of other data files, stay valid.
+        The dropped MarketPanels are not extended in place, they are rebuilt from the appended cache on their next
+        request. Panels published in /dev/shm are not updated either, but their name includes the data version (see
+        get_shared_market_panel_name), so a stale panel is not attached to.
+        """
+        version, num_rows_appended, last_day = ingest_data_file(data_file_name, data_format=data_format)
+        if num_rows_appended == 0:
+            return version, num_rows_appended
+
+        def is_affected(stock_names, date_end):
+            if date_end is not None and last_day is not None and get_date_ordinals(date_end) <= last_day:
+                return False
+            return any(data_file_name in get_source_data_file_names(stock_name) for stock_name in stock_names)
+
+        for key in [key for key in self.stock_data if is_affected([key[0]], key[2])]:
+            del self.stock_data[key]
+        # the dates axis (and the rates interpolated to it) is that of SP500
+        for key in [key for key in self.dates if is_affected(['SP500'], key[1])]:
+            del self.dates[key]
+            self.year_labels.pop(key, None)
+            for interpolated_key in [x for x in self.interpolated_rates if x[1:] == key]:
+                del self.interpolated_rates[interpolated_key]
+        for key in [key for key in self.market_panels if is_affected(list(key[0]) + ['SP500'], key[2])]:
+            del self.market_panels[key]
+        for key in [key for key in self.daily_factors if is_affected(
+                [key[0], str(self.instrument_registry.get_instrument(key[0])['underlying_index']), 'SP500'], key[2])]:
+            del self.daily_factors[key]
+        for key in [key for key in self.dividend_fractions if is_affected(['SP500'], key[2])]:
+            del self.dividend_fractions[key]
+        return version, num_rows_appended
+
+    def get_stock_data(self, stock_name, date_start=None, date_end=None, close_type='Close', settings=None):
+        num_trading_days_in_year = None if settings is None else settings['num_trading_days_in_year']
+        key = (stock_name, date_start, date_end, close_type, num_trading_days_in_year)
+        if key not in self.stock_data:
+            _, _, _, dividend_yield = self.get_stock_parameters(['NDX100'])
+            dates, values = load_stock_data(stock_name, date_start, date_end, close_type=close_type,
+                                            dividend_yield=dividend_yield, settings=settings)
+            values = np.array(values, dtype=float)
+            values.setflags(write=False)
+            self.stock_data[key] = (tuple(dates), values)
+        dates, values = self.stock_data[key]
+        return list(dates), values
+
+    def get_dates(self, date_start=None, date_end=None):
+        """
+        the dates axis mutual to all the portfolio ingredients, SP500 index has the "oldest" trading dates data
+        """
+        key = (date_start, date_end)
+        if key not in self.dates:
+            dates, _ = self.get_stock_data('SP500', date_start, date_end)
+            self.dates[key] = tuple(dates)
+        return list(self.dates[key])
+
+    def get_year_labels(self, date_start=None, date_end=None):
+        key = (date_start, date_end)
+        if key not in self.year_labels:
+            inds_years, label_years = get_year_labels(self.get_dates(date_start, date_end))
+            self.year_labels[key] = (tuple(inds_years), tuple(label_years))
+        inds_years, label_years = self.year_labels[key]
+        return list(inds_years), list(label_years)
+
+    def get_rate_series(self, series_name):
+        """
+        macro series (see load_rate_series) as a DateIndex and read-only values, loaded once per process
+        """
+        if series_name not in self.rate_series:
+            self.rate_series[series_name] = load_rate_series(series_name)
+        return self.rate_series[series_name]
+
+    def get_interpolated_rate(self, series_name, date_start=None, date_end=None):
+        """
+        macro series interpolated to the dates axis of the time window
+        """
+        key = (series_name, date_start, date_end)
+        if key not in self.interpolated_rates:
+            rate = interpolate_rate_series(series_name, self.get_dates(date_start, date_end), data_store=self)
+            rate.setflags(write=False)
+            self.interpolated_rates[key] = rate
+        return self.interpolated_rates[key]
+
+    def get_libor_rate(self, date_start=None, date_end=None):
+        return self.get_interpolated_rate('libor', date_start, date_end)
+
+    def get_market_panel(self, stock_names, date_start=None, date_end=None, settings=None):
+        """
+        MarketPanel of the daily returns of stock_names (data series names, e.g. the underlying indices).
+        A memoized panel of the time window that contains all of stock_names (e.g. a larger panel attached from
+        shared memory, see attach_market_panel) is used as is, its other series are ignored.
+        """
+        num_trading_days_in_year = None if settings is None else settings['num_trading_days_in_year']
+        key = (tuple(stock_names), date_start, date_end, num_trading_days_in_year)
+        if key not in self.market_panels:
+            for panel_key, market_panel in self.market_panels.items():
+                if panel_key[1:] == key[1:] and all([stock_name in market_panel.columns for stock_name in stock_names]):
+                    return market_panel
+            market_panel = build_market_panel(stock_names, date_start, date_end, settings=settings, data_store=self)
+            market_panel.window = (date_start, date_end, num_trading_days_in_year)
+            self.market_panels[key] = market_panel
+        return self.market_panels[key]
+
+    def add_market_panel(self, market_panel):
+        """
+        Memoize a prepared MarketPanel (e.g. attached from shared memory), together with the dates axis and libor
+        rate of its time window, so that loading the data for the window does not read any data file.
+        """
+        date_start, date_end, num_trading_days_in_year = market_panel.window
+        key = (tuple(market_panel.stock_names), date_start, date_end, num_trading_days_in_year)
+        self.market_panels[key] = market_panel
+        self.dates[(date_start, date_end)] = tuple(market_panel.date_index.get_dates())
+        self.interpolated_rates[('libor', date_start, date_end)] = market_panel.libor_rate
+
+    def find_market_panel(self, stock_name, date_start=None, date_end=None, settings=None):
+        """
+        a memoized MarketPanel of the time window that contains stock_name, or a new panel of stock_name alone
+        """
+        return self.get_market_panel([stock_name], date_start, date_end, settings=settings)
+
+    def get_daily_factors(self, stock_name, date_start=None, date_end=None, settings=None):
+        """
+        daily factor of the value of a stock over the time window, see get_daily_factors
+        """
+        key = (stock_name, date_start, date_end, settings['num_trading_days_in_year'])
+        if key not in self.daily_factors:
+            instrument = self.instrument_registry.get_instrument(stock_name)
+            index_name = str(instrument['underlying_index'])
+            market_panel = self.find_market_panel(index_name, date_start, date_end, settings=settings)
+            daily_factors = get_daily_factors(instrument, market_panel.get_returns(index_name),
+                                              market_panel.libor_rate, settings['num_trading_days_in_year'])
+            daily_factors.setflags(write=False)
+            self.daily_factors[key] = daily_factors
+        return self.daily_factors[key]
+
+    def get_dividend_fractions(self, stock_name, date_start=None, date_end=None, settings=None):
+        """
+        daily dividend fraction of a stock over the time window, see get_dividend_fractions
+        """
+        key = (stock_name, date_start, date_end, settings['num_trading_days_in_year'])
+        if key not in self.dividend_fractions:
+            dividend_fractions = get_dividend_fractions(self.instrument_registry.get_instrument(stock_name),
+                                                        self.get_libor_rate(date_start, date_end),
+                                                        settings['num_trading_days_in_year'])
+            dividend_fractions.setflags(write=False)
+            self.dividend_fractions[key] = dividend_fractions
+        return self.dividend_fractions[key]
+
+
+def get_shared_market_panel_path(name):
+    # /dev/shm is memory backed, so mapping the file shares the same physical pages between all the processes
+    shared_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return shared_dir + '/market_panel_' + name
+
+
+def get_shared_market_panel_name(name, stock_names):
+    """
+    The name to publish a MarketPanel of stock_names under: name followed by a hash of the data versions of the files
+    the panel is built from (see get_data_version), so that after new rows are ingested into one of the files a new
+    panel is published instead of attaching to the stale one.
+    """
+    data_versions = []
+    for stock_name in ['SP500'] + list(stock_names):
+        for data_file_name in get_source_data_file_names(stock_name):
+            data_versions += [(data_file_name, get_data_version(data_file_name))]
+    return name + '_data_' + hashlib.sha256(str(sorted(set(data_versions))).encode()).hexdigest()[:12]
+
+
+def publish_market_panel(market_panel, name, dividend_index_names=()):
+    """
+    Write the arrays of a MarketPanel (calendar ordinals, returns, libor rate and dividend yields) into a single
+    memory-mapped file under /dev/shm, so that all the worker processes of a node (also independent processes launched
+    by slurm) can attach to it by name without copying or loading data files.
+    Call unpublish_market_panel(name) when done.
+    """
+    arrays = {'ordinals': market_panel.date_index.ordinals, 'returns': market_panel.returns,
+              'libor_rate': market_panel.libor_rate}
+    for index_name in dividend_index_names:
+        arrays['dividend_yield_' + index_name] = market_panel.get_dividend_yield(index_name)
+
+    # the file begins with the length of a json header that describes the layout of the arrays
+    header = {'stock_names': market_panel.stock_names, 'window': list(market_panel.window), 'arrays': {}}
+    offset = 0
+    for array_name, array in arrays.items():
+        header['arrays'][array_name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += int(np.ceil(array.nbytes / 64.0)) * 64
+    header_bytes = json.dumps(header).encode()
+    data_offset = int(np.ceil((8 + len(header_bytes)) / 64.0)) * 64
+
+    file_path = get_shared_market_panel_path(name)
+    tmp_file_path = file_path + '.' + str(os.getpid()) + '.tmp'
+    buffer = np.memmap(tmp_file_path, dtype=np.uint8, mode='w+', shape=(data_offset + offset,))
+    buffer[0:8] = np.frombuffer(np.array([len(header_bytes)], dtype=np.uint64).tobytes(), dtype=np.uint8)
+    buffer[8:8 + len(header_bytes)] = np.frombuffer(header_bytes, dtype=np.uint8)
+    for array_name, array in arrays.items():
+        shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=buffer,
+                                  offset=data_offset + header['arrays'][array_name]['offset'])
+        shared_array[...] = array
+    buffer.flush()
+    del buffer
+    # workers never see a partially written panel
+    os.replace(tmp_file_path, file_path)
+    return file_path
+
+
+def unpublish_market_panel(name):
+    """
+    remove a published MarketPanel, processes that are already attached keep their mapping
+    """
+    os.remove(get_shared_market_panel_path(name))
+
+
+def attach_market_panel(name, data_store=None):
+    """
+    Attach to a MarketPanel published by publish_market_panel, the arrays are read-only views of the shared pages.
+    The panel is also added to the market data store (the process-wide one by default), so load_data uses it.
+    """
+    if data_store is None:
+        data_store = market_data_store
+    buffer = np.memmap(get_shared_market_panel_path(name), dtype=np.uint8, mode='r')
+
+    header_length = int(buffer[0:8].view(np.uint64)[0])
+    header = json.loads(buffer[8:8 + header_length].tobytes().decode())
+    data_offset = int(np.ceil((8 + header_length) / 64.0)) * 64
+    arrays = {}
+    for array_name, array_info in header['arrays'].items():
+        arrays[array_name] = np.ndarray(array_info['shape'], dtype=np.dtype(array_info['dtype']), buffer=buffer,
+                                        offset=data_offset + array_info['offset'])
+
+    market_panel = MarketPanel(DateIndex(arrays['ordinals']), header['stock_names'], arrays['returns'],
+                               arrays['libor_rate'])
+    for array_name in arrays.keys():
+        if array_name.startswith('dividend_yield_'):
+            market_panel.dividend_yields[array_name[len('dividend_yield_'):]] = arrays[array_name]
+    market_panel.window = tuple(header['window'])
+
+    data_store.add_market_panel(market_panel)
+    return market_panel
+
+
+def lock_shared_market_panel(name, timeout_seconds=600):
+    """
+    take the lock of a published MarketPanel, a lock file created exclusively (O_EXCL) so only one process holds it
+    """
+    lock_file_path = get_shared_market_panel_path(name) + '.lock'
+    time_start = time.time()
+    while True:
+        try:
+            os.close(os.open(lock_file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return
+        except FileExistsError:
+            if time.time() - time_start > timeout_seconds:
+                raise TimeoutError('lock of market panel ' + name + ' is held for more than ' + str(timeout_seconds)
+                                   + ' seconds, remove ' + lock_file_path + ' if its process is dead.')
+            time.sleep(0.1)
+
+
+def unlock_shared_market_panel(name):
+    os.remove(get_shared_market_panel_path(name) + '.lock')
+
+
+def update_shared_market_panel_users(name, change):
+    """
+    add change to the count of the processes that use a published MarketPanel (kept in a file next to it)
+    """
+    users_file_path = get_shared_market_panel_path(name) + '.users'
+    num_users = 0
+    if os.path.exists(users_file_path):
+        with open(users_file_path) as users_file:
+            num_users = int(users_file.read())
+    num_users += change
+    if num_users > 0:
+        with open(users_file_path, 'w') as users_file:
+            users_file.write(str(num_users))
+    elif os.path.exists(users_file_path):
+        os.remove(users_file_path)
+    return num_users
+
+
+def acquire_shared_market_panel(name, stock_names, date_start, date_end, settings=None, data_store=None):
+    """
+    Attach to the MarketPanel published under name, the first process (e.g. the first slave of a sweep on a node)
+    prepares it with the market data store and publishes it, holding the lock so that a single process builds it.
+    Every process that acquires the panel must call release_shared_market_panel(name) when done, the last one removes
+    it from /dev/shm.
+    """
+    if data_store is None:
+        data_store = market_data_store
+    lock_shared_market_panel(name)
+    try:
+        if not os.path.exists(get_shared_market_panel_path(name)):
+            publish_market_panel(data_store.get_market_panel(stock_names, date_start, date_end, settings=settings),
+                                 name)
+        update_shared_market_panel_users(name, 1)
+    finally:
+        unlock_shared_market_panel(name)
+    return attach_market_panel(name, data_store=data_store)
+
+
+def release_shared_market_panel(name):
+    """
+    stop counting this process as a user of a published MarketPanel, and unpublish it if it was the last one
+    """
+    lock_shared_market_panel(name)
+    try:
+        if update_shared_market_panel_users(name, -1) <= 0:
+            unpublish_market_panel(name)
+    finally:
+        unlock_shared_market_panel(name)
+
+
+market_data_store = MarketDataStore()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import time
+import numpy as np
+
+from data_functions import ingest_data_file, get_data_format
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_file_names', help='names of the csv data files (without .csv) to ingest, default is all the '
+                                              'stock data files under data/', type=str, nargs='+', default=None)
+
+args = parser.parse_args()
+
+data_file_names = args.data_file_names
+if data_file_names is None:
+    main_dir = os.path.dirname(os.path.abspath(__file__))
+    data_file_names = []
+    for file_name in sorted(os.listdir(main_dir + '/data')):
+        if file_name.endswith('.csv'):
+            try:
+                get_data_format(file_name[:-len('.csv')])
+                data_file_names += [file_name[:-len('.csv')]]
+            except ValueError:
+                # not a stock data file (e.g. libor rates, dividend yields)
+                pass
+
+for data_file_name in data_file_names:
+    t_start = time.time()
+    version, num_rows_appended, last_day = ingest_data_file(data_file_name)
+    run_time = time.time() - t_start
+    last_day = 'none' if last_day is None else str(np.datetime64(last_day, 'D'))
+    print(data_file_name + ': appended ' + str(num_rows_appended) + ' rows after ' + last_day
+          + ', data version ' + str(version) + ', run time ' + '{:.3f}'.format(run_time) + ' sec')
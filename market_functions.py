@@ -1,6 +1,8 @@
 import numpy as np
-from data_functions import load_stock_data, get_libor_rate, define_stock_parameters
-from aux_functions import get_year_labels
+import collections
+from data_functions import market_data_store, MarketPanel
+from metrics_functions import calculate_risk_metrics_batch, get_drawdown
+from bootstrap_functions import get_bootstrap_indices
 
 
 def simulate_portfolio_evolution(settings):
@@ -18,31 +20,18 @@ def simulate_portfolio_evolution(settings):
     data = initialize_portfolio(settings, data)
     data = calculate_portfolio_fractions(settings, data, 0)
 
-    # loop over days of simulation
-    for ind_date, date in enumerate(data['dates']):
-        if ind_date > 0 and data['simulation_status'] == 'nominal':
-
-            # calculate fractions of the total portfolio components
-            data = calculate_portfolio_fractions(settings, data, ind_date)
-
-            # evolve the portfolio elements with the passing day stock changes
-            data = evolve_portfolio_single_day(settings, data, ind_date)
-
-            # check if cash invest criterion reached, invest to try and balance
-            # each buy is added to the portfolio for later
-            if check_invest_criterion_reached(settings, data):
-                data = add_cash_to_portfolio(settings, data, ind_date)
-
-            # check if rebalancing criterion reached
-            # buy/sell according to strategy and update the portfolio
-            # save date of operation to calculate statistics of operations frequency
-            if check_rebalancing_criterion_reached(settings, data, ind_date):
-                data = rebalance_portfolio(settings, data, ind_date)
-
-            # check if tax criterion reached (end of year), sell some to withdraw for tax
-            # save cumulative amount of paid tax
-            if check_tax_criterion_reached(settings, data):
-                data = sell_papers_for_tax(settings, data, ind_date)
+    # loop over days of simulation.
+    # the days between events (invest, rebalance, tax) only evolve the portfolio, so they are evolved in bulk segments
+    # up to the next scheduled event or the first day a rebalance threshold is crossed, which is simulated day by day
+    ind_date = 1
+    while ind_date < len(data['dates']) and data['simulation_status'] == 'nominal':
+        ind_end = min(get_next_scheduled_event_day(settings, data, ind_date), len(data['dates']))
+        if settings['record'] == 'summary':
+            data = roll_history(settings, data, ind_date, ind_end)
+        ind_event = evolve_portfolio_segment(settings, data, ind_date, ind_end)
+        if ind_event < len(data['dates']):
+            data = simulate_portfolio_single_day(settings, data, ind_event)
+        ind_date = ind_event + 1
 
     # track the open/closed papers for visualization
     data = track_paper_status(settings, data)
@@ -56,46 +45,93 @@ def simulate_portfolio_evolution(settings):
     return data
 
 
-def load_data(settings):
+def simulate_portfolio_single_day(settings, data, ind_date):
+    """
+    the full simulation of a single day, with the checks of all the events
+    """
+    # calculate fractions of the total portfolio components
+    data = calculate_portfolio_fractions(settings, data, ind_date)
+
+    # evolve the portfolio elements with the passing day stock changes
+    data = evolve_portfolio_single_day(settings, data, ind_date)
+
+    # check if cash invest criterion reached, invest to try and balance
+    # each buy is added to the portfolio for later
+    if check_invest_criterion_reached(settings, data):
+        data = add_cash_to_portfolio(settings, data, ind_date)
+
+    # check if rebalancing criterion reached
+    # buy/sell according to strategy and update the portfolio
+    # save date of operation to calculate statistics of operations frequency
+    if check_rebalancing_criterion_reached(settings, data, ind_date):
+        data = rebalance_portfolio(settings, data, ind_date)
+
+    # check if tax criterion reached (end of year), sell some to withdraw for tax
+    # save cumulative amount of paid tax
+    if check_tax_criterion_reached(settings, data):
+        data = sell_papers_for_tax(settings, data, ind_date)
+
+    return data
+
+
+def load_data(settings, data_store=None):
+    """
+    load the market data for the simulation time window, memoized by the process-wide market data store
+    """
+    if data_store is None:
+        data_store = market_data_store
     data = {}
 
-    # general stock parameters
-    expense_ratios, leverage_factors, underlying_index, dividend_yield = define_stock_parameters()
+    # check that portfolio fractions are all positive (and remove zeros if exist)
+    stock_names = list(settings['ideal_portfolio_fractions'].keys())
+    for stock_name in stock_names:
+        if settings['ideal_portfolio_fractions'][stock_name] < 0:
+            raise ValueError('negative portfolio fraction for ' + str(stock_name))
+        elif settings['ideal_portfolio_fractions'][stock_name] == 0:
+            settings['ideal_portfolio_fractions'].pop(stock_name)
+    stock_names = list(settings['ideal_portfolio_fractions'].keys())
+
+    # general stock parameters, leveraged variants named <stock_name>x<leverage> are registered on demand
+    instrument_registry = data_store.instrument_registry
+    expense_ratios, leverage_factors, underlying_index, dividend_yield = instrument_registry.get_stock_parameters(
+        stock_names)
     data['expense_ratios'] = expense_ratios
     data['leverage_factors'] = leverage_factors
     data['underlying_index'] = underlying_index
     data['dividend_yield'] = dividend_yield
+    data['dividend_models'] = instrument_registry.get_dividend_models(stock_names)
+    data['instruments'] = {stock_name: instrument_registry.get_instrument(stock_name) for stock_name in stock_names}
 
     # define the dates axis that will be mutual for all the portfolio ingredients
     date_start = settings['date_start']
     date_end = settings['date_end']
-    dates, _ = load_stock_data('SP500', date_start, date_end)  # SP500 index has the "oldest" trading dates data
-    inds_years, label_years = get_year_labels(dates)
+    dates = data_store.get_dates(date_start, date_end)
+    inds_years, label_years = data_store.get_year_labels(date_start, date_end)
     data['dates'] = dates
     data['inds_years'] = inds_years
     data['label_years'] = label_years
 
     # load libor_rate (relevant to leveraged etf sim)
-    libor_rate = get_libor_rate(dates)
+    libor_rate = data_store.get_libor_rate(date_start, date_end)
     data['libor_rate'] = libor_rate
 
-    # check that portfolio fractions are all positive (and remove zeros if exist)
-    stock_names = settings['ideal_portfolio_fractions'].keys()
-    zero_stocks = []
+    # daily returns of the indices underlying the stocks of the portfolio, on the mutual dates axis
+    index_names = []
     for stock_name in stock_names:
-        if settings['ideal_portfolio_fractions'][stock_name] < 0:
-            raise ValueError('negative portfolio fraction for ' + str(stock_name))
-        elif settings['ideal_portfolio_fractions'][stock_name] == 0:
-            zero_stocks += [stock_name]
-    for stock_name in zero_stocks:
-        settings['ideal_portfolio_fractions'].pop(stock_name)
-
-    # stocks to be a part of the portfolio
+        if underlying_index[stock_name] not in index_names:
+            index_names += [underlying_index[stock_name]]
+    data['market_panel'] = data_store.get_market_panel(index_names, date_start, date_end, settings=settings)
+
+    # stocks to be a part of the portfolio, with the daily factor of their papers and their daily dividend fraction
+    data['returns'] = {}
+    data['daily_factors'] = {}
+    data['dividend_fractions'] = {}
     for stock_name in stock_names:
-        index_name = underlying_index[stock_name]
-        _, stock_values = load_stock_data(index_name, date_start, date_end,
-                                          dividend_yield=dividend_yield, settings=settings)
-        data[stock_name] = stock_values
+        data['returns'][stock_name] = data['market_panel'].get_returns(underlying_index[stock_name])
+        data['daily_factors'][stock_name] = data_store.get_daily_factors(stock_name, date_start, date_end,
+                                                                         settings=settings)
+        data['dividend_fractions'][stock_name] = data_store.get_dividend_fractions(stock_name, date_start, date_end,
+                                                                                   settings=settings)
 
     return settings, data
 
@@ -108,11 +144,8 @@ def generate_synthetic_realization(settings, data):
     """
     if settings['generate_synthetic_realization']:
         # generate random indices
-        np.random.seed(settings['seed'])
-        num_days_synthetic = settings['synthetic_period_years'] * settings['num_trading_days_in_year']
-        high = len(data['dates']) - settings['num_correlation_days']
-        size = int(np.ceil(1.0 * num_days_synthetic / settings['num_correlation_days']))
-        inds_bootstrap = np.random.randint(low=1, high=high, size=size)
+        inds_data = get_synthetic_data_indices(settings, len(data['dates']), settings['seed'])
+        num_days_synthetic = len(inds_data)
 
         # change the dates list to be as long as needed (the values themselves become meaningless)
         data['dates'] = [data['dates'][0] for _ in range(num_days_synthetic)]
@@ -121,38 +154,80 @@ def generate_synthetic_realization(settings, data):
         data['label_years'] = [str(int(i / settings['num_trading_days_in_year'])) for i in range(num_days_synthetic)
                                if np.mod(i, settings['num_trading_days_in_year']) == 0]
 
-        # initialize synthetic data arrays
-        stock_names = settings['ideal_portfolio_fractions'].keys()
-        libor_rate_synth = np.zeros(len(data['dates']))
-        data_synthetic = {}
-        for stock_name in stock_names:
-            data_synthetic[stock_name] = np.ones(len(data['dates']))
-
-        for i, ind_bootstrap in enumerate(inds_bootstrap):
-            for j in range(settings['num_correlation_days']):
-                ind_synth = settings['num_correlation_days'] * i + j
-                ind_data = ind_bootstrap + j
-                if ind_synth < num_days_synthetic:
-                    for stock_name in stock_names:
-                        libor_rate_synth[ind_synth] = data['libor_rate'][ind_data]
-                        data_synthetic[stock_name][ind_synth] = data_synthetic[stock_name][ind_synth - 1] \
-                                                                * data[stock_name][ind_data] \
-                                                                / data[stock_name][ind_data - 1]
+        returns_synth = data['market_panel'].returns[inds_data]
+        returns_synth.setflags(write=False)
+        libor_rate_synth = data['libor_rate'][inds_data]
 
         # overwrite the real data with the synthetic data
+        data['market_panel'] = MarketPanel(None, data['market_panel'].stock_names, returns_synth, libor_rate_synth)
         data['libor_rate'] = libor_rate_synth
-        for stock_name in stock_names:
-            data[stock_name] = data_synthetic[stock_name]
+        # the daily series are computed day by day, so the synthetic ones are the same days of the real series
+        for stock_name in data['returns'].keys():
+            data['returns'][stock_name] = data['market_panel'].get_returns(data['underlying_index'][stock_name])
+            data['daily_factors'][stock_name] = data['daily_factors'][stock_name][inds_data]
+            data['dividend_fractions'][stock_name] = data['dividend_fractions'][stock_name][inds_data]
 
     return data
 
 
+def get_synthetic_data_indices(settings, num_dates, seed):
+    """
+    Rows of the market data that make up a synthetic realization, resampled by the bootstrap_method of the settings
+    (see get_bootstrap_indices) with blocks of num_correlation_days days on average.
+    A numpy SeedSequence seed (see get_realization_seed_sequences) draws with its own Generator, any other seed draws
+    with the global numpy random generator seeded by seed.
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        rng = np.random.default_rng(seed)
+    else:
+        np.random.seed(seed)
+        rng = None
+    num_days_synthetic = settings['synthetic_period_years'] * settings['num_trading_days_in_year']
+    return get_bootstrap_indices(settings['bootstrap_method'], num_dates, num_days_synthetic,
+                                 settings['num_correlation_days'], 1, rng)[0]
+
+
+def generate_synthetic_paths(settings, data, seeds):
+    """
+    Synthetic realizations of many seeds at once (the same as generate_synthetic_realization with each seed), as the
+    daily factors and dividend fractions of the stocks in (realizations x days x stocks) arrays that are gathered from
+    the series of the time window. For back-testing all the realizations are the real days.
+    """
+    stock_names = list(settings['ideal_portfolio_fractions'].keys())
+    num_dates = len(data['dates'])
+    if settings['generate_synthetic_realization']:
+        # every realization has its own random stream (its seed), so that it is the same in any batch or shard it is
+        # simulated in, hence the indices are drawn seed by seed (a small part of the cost, the gather dominates)
+        inds_data = np.array([get_synthetic_data_indices(settings, num_dates, seed) for seed in seeds], dtype=int)
+    else:
+        inds_data = np.tile(np.arange(num_dates), [len(seeds), 1])
+
+    paths = {}
+    for series_name in ['daily_factors', 'dividend_fractions']:
+        series = np.stack([data[series_name][stock_name] for stock_name in stock_names], axis=1)
+        paths[series_name] = series[inds_data]
+    return paths
+
+
+def iterate_synthetic_paths(settings, data, seeds, chunk_size):
+    """
+    generate the synthetic realizations of the seeds in chunks of chunk_size seeds (see generate_synthetic_paths),
+    yields the seeds of each chunk and their paths
+    """
+    for ind_start in range(0, len(seeds), chunk_size):
+        chunk_seeds = seeds[ind_start:ind_start + chunk_size]
+        yield chunk_seeds, generate_synthetic_paths(settings, data, chunk_seeds)
+
+
 def initialize_portfolio(settings, data):
     """
     first purchase of stocks according to the required fractions
     """
     data['simulation_status'] = 'nominal'
 
+    if settings['record'] not in ['full', 'summary']:
+        raise ValueError('invalid record: ' + str(settings['record']))
+
     ideal_portfolio_fractions = settings['ideal_portfolio_fractions']
     stock_names = ideal_portfolio_fractions.keys()
 
@@ -165,46 +240,47 @@ def initialize_portfolio(settings, data):
         raise ValueError('margin_leverage_target must be greater than 1.')
 
     # buy the initial papers for the portfolio
-    papers_dict = {}  # will contain all the paper purchases, different list per stock name
+    # without capital gains taxes the papers need not be tracked one by one, so a single aggregated position is kept
+    # per stock (the profit of the final sell depends on the order the papers were sold in, so with a final sell tax
+    # the papers are kept)
+    data['aggregate_positions'] = settings['tax_scheme'] == 'none' and settings['capital_gains_tax_percents'] == 0 \
+                                  and settings['total_sell_capital_gains_tax_percents'] == 0
+    data['lot_books'] = {}  # will contain all the paper purchases, different LotBook per stock name
     for stock_name in stock_names:
-        papers = []
-        paper = {}
-        paper['id'] = 0
-        paper['stock_name'] = stock_name
-        paper['value_at_buy'] = ideal_portfolio_fractions[stock_name] * settings['initial_investment'] \
-                                * (1 - settings['transaction_fee_percents'] / 100.0) \
-                                * settings['margin_leverage_target']
-        paper['value_current'] = paper['value_at_buy']
-        paper['date'] = data['dates'][0]
-        paper['ind_day_at_buy'] = 0
-        paper['status'] = 'open'
-        papers += [paper]
-        papers_dict[stock_name] = papers
-    data['papers_dict'] = papers_dict
-    data['total_portfolio_value'] = np.nan * np.zeros(len(data['dates']))
+        if data['aggregate_positions']:
+            data['lot_books'][stock_name] = AggregatedPosition()
+        else:
+            # the closed papers are only needed for the paper tracking of the full record
+            data['lot_books'][stock_name] = LotBook(settings['tax_scheme'],
+                                                    keep_archive=settings['record'] == 'full')
+        value_at_buy = ideal_portfolio_fractions[stock_name] * settings['initial_investment'] \
+                       * (1 - settings['transaction_fee_percents'] / 100.0) \
+                       * settings['margin_leverage_target']
+        data['lot_books'][stock_name].add_lot(value_at_buy, 0)
+    data['total_portfolio_value'] = create_history(settings, data)
     data['total_portfolio_value'][0] = settings['initial_investment'] * settings['margin_leverage_target']
-    data['total_investment'] = np.nan * np.zeros(len(data['dates']))
+    data['total_investment'] = create_history(settings, data)
     data['total_investment'][0] = settings['initial_investment']
 
     data['portfolio_fractions'] = {}
     for stock_name in stock_names:
-        data['portfolio_fractions'][stock_name] = np.nan * np.zeros(len(data['dates']))
+        data['portfolio_fractions'][stock_name] = create_history(settings, data)
 
     # initialize the gains that need to be tracked for taxes
-    data['gains'] = np.nan * np.zeros(len(data['dates']))
+    data['gains'] = create_history(settings, data)
     data['gains'][0] = 0
 
     # initialize the total taxes paid
-    data['taxes_paid'] = np.nan * np.zeros(len(data['dates']))
+    data['taxes_paid'] = create_history(settings, data)
     data['taxes_paid'][0] = 0
 
     # initialize the cash in account (will be accumulated due to dividends and then reinvested)
-    data['cash_in_account'] = np.nan * np.zeros(len(data['dates']))
+    data['cash_in_account'] = create_history(settings, data)
     data['cash_in_account'][0] = - settings['initial_investment'] * (settings['margin_leverage_target'] - 1.0)
 
     # initialize margin debt and leverage
-    data['margin_debt'] = np.nan * np.zeros(len(data['dates']))
-    data['margin_leverage'] = np.nan * np.zeros(len(data['dates']))
+    data['margin_debt'] = create_history(settings, data)
+    data['margin_leverage'] = create_history(settings, data)
     data = calculate_margin_state(settings, data, 0)
 
     # initialize additional counters
@@ -214,19 +290,325 @@ def initialize_portfolio(settings, data):
     data['number_of_buy_days'] = 0
     data['number_of_sell_days'] = 0
 
+    # streaming risk metrics of the yield history, for the summary record (see update_risk_metrics)
+    data['ind_date_risk_metrics'] = 0
+    data['yield_min'] = np.inf
+    data['yield_max'] = -np.inf
+    data['yield_peak'] = 0.0  # the running maximum of the drawdown starts at 0
+    data['max_drawdown'] = -np.inf
+
     return data
 
 
+def create_history(settings, data):
+    """
+    per-day history array of the simulation, only a rolling window of days for the summary record
+    """
+    if settings['record'] == 'summary':
+        return RollingHistory(len(data['dates']), get_history_window_size(settings))
+    return np.nan * np.zeros(len(data['dates']))
+
+
+def get_history_arrays(data):
+    return [data['total_portfolio_value'], data['total_investment'], data['gains'], data['taxes_paid'],
+            data['cash_in_account'], data['margin_debt'], data['margin_leverage']] \
+           + list(data['portfolio_fractions'].values())
+
+
+def roll_history(settings, data, ind_date, ind_end):
+    """
+    Move the window of the rolling histories forward if the days up to ind_end (the previous day ind_date - 1 is still
+    needed) do not fit in it. The days that are done are streamed into the risk metrics before they are rolled out.
+    """
+    if min(ind_end, len(data['dates']) - 1) < data['total_portfolio_value'].get_window_end():
+        return data
+    data = update_risk_metrics(settings, data, ind_date)
+    for history in get_history_arrays(data):
+        history.roll(ind_date - 1)
+    return data
+
+
+def get_history_window_size(settings):
+    """
+    Days kept by the rolling history: the previous day and the days up to the next scheduled event, which is at most
+    an invest interval away since cash is always added periodically.
+    """
+    return int(np.ceil(get_days_between_invests(settings))) + 2
+
+
+class RollingHistory:
+    """
+    A per-day history that keeps only a window of consecutive days, so that its memory does not grow with the
+    simulation period. It is indexed by day (or a slice of days) like the full-length array, negative indices count
+    from the last day of the simulation, and the days must be in the current window.
+    """
+    __slots__ = ['values', 'ind_first', 'num_days']
+
+    def __init__(self, num_days, window_size):
+        self.values = np.nan * np.zeros(min(window_size, num_days))
+        self.ind_first = 0
+        self.num_days = num_days
+
+    def __len__(self):
+        return self.num_days
+
+    def get_window_index(self, key):
+        if isinstance(key, slice):
+            if key.step is not None:
+                raise IndexError('rolling history does not support slice steps')
+            start = 0 if key.start is None else key.start
+            stop = self.num_days if key.stop is None else key.stop
+            if (start + self.num_days if start < 0 else start) >= (stop + self.num_days if stop < 0 else stop):
+                return slice(0, 0)
+            return slice(self.get_window_index(start), self.get_window_index(stop - 1) + 1)
+        ind_date = key + self.num_days if key < 0 else key
+        ind_window = ind_date - self.ind_first
+        if not 0 <= ind_window < len(self.values):
+            raise IndexError('day ' + str(key) + ' is outside the rolling history window')
+        return ind_window
+
+    def __getitem__(self, key):
+        return self.values[self.get_window_index(key)]
+
+    def __setitem__(self, key, value):
+        self.values[self.get_window_index(key)] = value
+
+    def get_window_end(self):
+        return self.ind_first + len(self.values)
+
+    def roll(self, ind_first):
+        """
+        move the window to start at day ind_first, keeping the days that remain in it
+        """
+        num_kept = max(self.get_window_end() - ind_first, 0)
+        self.values[:num_kept] = self.values[len(self.values) - num_kept:]
+        self.values[num_kept:] = np.nan
+        self.ind_first = ind_first
+
+
+class LotBook:
+    """
+    The papers (lots) bought of a single stock, as growable arrays indexed by paper.
+    All the papers of a stock grow by the same daily factor, so only the cumulative growth index of the stock is evolved.
+    A paper holds units (its value at buy divided by the growth index at buy), and its current value is its units
+    times the growth index.
+    The open papers are kept in a deque in the order they are to be sold by the tax scheme: in order of purchase for
+    FIFO/LIFO, and re-sorted from least to most profitable at the start of every sale for 'optimized' and 'none' (see
+    sort_sell_order).
+    Papers that were sold entirely are retired from the live arrays into an archive that only keeps their buy day and
+    value at buy (see retire_closed_lots), or are dropped if keep_archive is False.
+    """
+    __slots__ = ['value_at_buy', 'units', 'ind_day_at_buy', 'is_open', 'num_lots', 'growth_index', 'position_units',
+                 'tax_scheme', 'sell_order', 'keep_archive', 'archived_value_at_buy', 'archived_ind_day_at_buy',
+                 'num_archived_lots']
+
+    def __init__(self, tax_scheme, capacity=16, keep_archive=True):
+        if tax_scheme not in ['FIFO', 'LIFO', 'optimized', 'none']:
+            raise ValueError('invalid tax_scheme: ' + str(tax_scheme))
+        self.value_at_buy = np.zeros(capacity)
+        self.units = np.zeros(capacity)
+        self.ind_day_at_buy = np.zeros(capacity, dtype=np.int32)
+        self.is_open = np.zeros(capacity, dtype=bool)
+        self.num_lots = 0
+        self.growth_index = 1.0
+        self.position_units = 0.0  # sum of the units of the open papers
+        self.tax_scheme = tax_scheme
+        self.sell_order = collections.deque()
+        self.keep_archive = keep_archive
+        self.archived_value_at_buy = np.zeros(capacity)
+        self.archived_ind_day_at_buy = np.zeros(capacity, dtype=np.int32)
+        self.num_archived_lots = 0
+
+    def __len__(self):
+        return self.num_lots
+
+    def grow_arrays(self, array_names, capacity):
+        """
+        double the size of the arrays until they can hold capacity papers
+        """
+        for array_name in array_names:
+            array = getattr(self, array_name)
+            new_size = len(array)
+            while new_size < capacity:
+                new_size *= 2
+            if new_size > len(array):
+                new_array = np.zeros(new_size, dtype=array.dtype)
+                new_array[:len(array)] = array
+                setattr(self, array_name, new_array)
+
+    def add_lot(self, value_at_buy, ind_day_at_buy):
+        """
+        add a new open paper
+        """
+        self.grow_arrays(['value_at_buy', 'units', 'ind_day_at_buy', 'is_open'], self.num_lots + 1)
+        ind_lot = self.num_lots
+        self.value_at_buy[ind_lot] = value_at_buy
+        self.units[ind_lot] = value_at_buy / self.growth_index
+        self.ind_day_at_buy[ind_lot] = ind_day_at_buy
+        self.is_open[ind_lot] = True
+        self.position_units += self.units[ind_lot]
+        self.num_lots += 1
+        self.sell_order.append(ind_lot)
+        return ind_lot
+
+    def evolve(self, factor):
+        self.growth_index *= factor
+        # rescale the units if the growth index is about to underflow/overflow, or reset them if the value was wiped out
+        if not 1e-100 < self.growth_index < 1e100:
+            self.units[:self.num_lots] *= self.growth_index
+            self.position_units *= self.growth_index
+            self.growth_index = 1.0
+
+    def get_lot_value(self, ind_lot):
+        return self.units[ind_lot] * self.growth_index
+
+    def get_lot_values(self):
+        return self.units[:self.num_lots] * self.growth_index
+
+    def get_lot_profits(self):
+        return self.get_lot_values() - self.value_at_buy[:self.num_lots]
+
+    def get_position_value(self):
+        return self.position_units * self.growth_index
+
+    def get_unrealized_profit(self):
+        return np.sum(self.get_lot_profits()[self.is_open[:self.num_lots]])
+
+    def get_num_open_lots(self):
+        return len(self.sell_order)
+
+    def sort_sell_order(self):
+        """
+        Sort the open papers for 'optimized' and 'none' from least to most profitable at the current date, to be called
+        before a sale (the unrealized profits change as the papers grow).
+        Profits within the rounding of the units (e.g. of papers bought on the same day) are taken as zero and papers
+        with equal profits are sold in order of purchase, so the order does not depend on floating point noise.
+        """
+        if self.tax_scheme in ['FIFO', 'LIFO']:
+            return
+        inds_open = np.nonzero(self.is_open[:self.num_lots])[0]
+        profits = self.get_lot_profits()[inds_open]
+        profits[np.abs(profits) <= 1e-12 * self.value_at_buy[inds_open]] = 0.0
+        inds_sorted = inds_open[np.lexsort((inds_open, self.ind_day_at_buy[inds_open], profits))]
+        self.sell_order = collections.deque(inds_sorted.tolist())
+
+    def get_next_lot(self):
+        """
+        the open paper to be sold next according to the tax scheme
+        """
+        if self.tax_scheme == 'LIFO':
+            return self.sell_order[-1]
+        else:
+            return self.sell_order[0]
+
+    def sell_lot_value(self, ind_lot, value):
+        """
+        sell part of the value of the next paper
+        """
+        units = value / self.growth_index
+        self.units[ind_lot] -= units
+        self.position_units -= units
+
+    def close_lot(self, ind_lot):
+        """
+        sell the entire value of the next paper, it stays in the live arrays until it is retired
+        """
+        self.position_units -= self.units[ind_lot]
+        self.units[ind_lot] = 0
+        self.is_open[ind_lot] = False
+        if self.tax_scheme == 'LIFO':
+            self.sell_order.pop()
+        else:
+            self.sell_order.popleft()
+        # the running sum of the units keeps a rounding residue, so a liquidated position is set to exactly zero (a
+        # nulled portfolio is detected by its value, see calculate_portfolio_fractions)
+        if self.get_num_open_lots() == 0:
+            self.position_units = 0.0
+
+    def retire_closed_lots(self):
+        """
+        Move the closed papers to the archive and compact the live arrays, keeping the order of the open papers.
+        Compacting is done once the closed papers are at least half of the live arrays, so that its cost is amortized
+        over the papers that were closed.
+        """
+        num_closed = self.num_lots - self.get_num_open_lots()
+        if num_closed == 0 or 2 * num_closed < self.num_lots:
+            return
+        is_open = self.is_open[:self.num_lots].copy()
+        if self.keep_archive:
+            self.grow_arrays(['archived_value_at_buy', 'archived_ind_day_at_buy'], self.num_archived_lots + num_closed)
+            inds_archive = slice(self.num_archived_lots, self.num_archived_lots + num_closed)
+            self.archived_value_at_buy[inds_archive] = self.value_at_buy[:self.num_lots][~is_open]
+            self.archived_ind_day_at_buy[inds_archive] = self.ind_day_at_buy[:self.num_lots][~is_open]
+            self.num_archived_lots += num_closed
+
+        num_open = self.num_lots - num_closed
+        for array_name in ['value_at_buy', 'units', 'ind_day_at_buy', 'is_open']:
+            array = getattr(self, array_name)
+            array[:num_open] = array[:self.num_lots][is_open]
+        self.num_lots = num_open
+
+        # the compaction keeps the order of the papers, so the sell order stays valid with the new indices
+        new_inds = (np.cumsum(is_open) - 1).tolist()
+        self.sell_order = collections.deque(new_inds[ind_lot] for ind_lot in self.sell_order)
+
+    def get_archived_ind_day_at_buy(self):
+        return self.archived_ind_day_at_buy[:self.num_archived_lots]
+
+
+class AggregatedPosition:
+    """
+    A single position per stock with its total cost basis, used instead of a LotBook when the papers need not be
+    tracked one by one (tax_scheme 'none' and no capital gains taxes).
+    Buying and selling are O(1), sales realize profit relative to the average cost basis.
+    """
+    __slots__ = ['growth_index', 'position_units', 'cost_basis']
+
+    def __init__(self):
+        self.growth_index = 1.0
+        self.position_units = 0.0
+        self.cost_basis = 0.0
+
+    def add_lot(self, value_at_buy, ind_day_at_buy):
+        self.position_units += value_at_buy / self.growth_index
+        self.cost_basis += value_at_buy
+
+    def evolve(self, factor):
+        self.growth_index *= factor
+        # rescale the units if the growth index is about to underflow/overflow, or reset them if the value was wiped out
+        if not 1e-100 < self.growth_index < 1e100:
+            self.position_units *= self.growth_index
+            self.growth_index = 1.0
+
+    def get_position_value(self):
+        return self.position_units * self.growth_index
+
+    def get_unrealized_profit(self):
+        return self.get_position_value() - self.cost_basis
+
+    def sell_value(self, value):
+        """
+        sell value out of the position (at most the entire position), returns the realized profit
+        """
+        position_value = self.get_position_value()
+        if value >= position_value:
+            profit = position_value - self.cost_basis
+            self.position_units = 0.0
+            self.cost_basis = 0.0
+            return profit
+        basis_sold = self.cost_basis * value / position_value
+        self.position_units -= value / self.growth_index
+        self.cost_basis -= basis_sold
+        return value - basis_sold
+
+
 def evolve_portfolio_single_day(settings, data, ind_date):
     """
     evolve each portfolio asset according to the stock it tracks
     evolve the leveraged assets, after taking the cut of expense-ratio and loan-rate (LIBOR).
     """
 
-    papers_dict = data['papers_dict']
-    expense_ratios = data['expense_ratios']
-    leverage_factors = data['leverage_factors']
-    dividend_yield = data['dividend_yield']
+    lot_books = data['lot_books']
 
     data['total_investment'][ind_date] = data['total_investment'][ind_date - 1]
     data['cash_in_account'][ind_date] = data['cash_in_account'][ind_date - 1]
@@ -240,35 +622,17 @@ def evolve_portfolio_single_day(settings, data, ind_date):
 
     data = calculate_margin_state(settings, data, ind_date)
 
-    for stock_name in papers_dict.keys():
-        leverage_factor = leverage_factors[stock_name]
-        stock_change_percents = 100 * (data[stock_name][ind_date] / data[stock_name][ind_date - 1] - 1)
-        leverage_change_percents = leverage_factor * stock_change_percents
-        expense_ratio_daily_percents = expense_ratios[stock_name] / settings['num_trading_days_in_year']
-        libor_rate_daily_percents = (leverage_factor - 1) \
-                                    * data['libor_rate'][ind_date] / settings['num_trading_days_in_year']
-        paper_change_percents = leverage_change_percents - expense_ratio_daily_percents - libor_rate_daily_percents
-        if paper_change_percents < -100:  # deal with case of total paper value loss
-            paper_change_percents = -100
-        paper_factor = 1 + paper_change_percents / 100.0
-
-        papers = papers_dict[stock_name]
-        for ind_paper, paper in enumerate(papers):
-            papers[ind_paper]['value_current'] *= paper_factor
-
-            # we assume the dividends are given on a daily basis for simplicity
-            if stock_name in ['VUSTX', 'TLT']:
-                # phenomenological model to treat the time varying dividend of bonds
-                curr_div_yield = dividend_yield[stock_name] + 0.5 * data['libor_rate'][ind_date]
-            else:
-                curr_div_yield = dividend_yield[stock_name]
-            dividend_fraction = curr_div_yield / 100.0 / settings['num_trading_days_in_year']
-            total_dividend_received = papers[ind_paper]['value_current'] * dividend_fraction
-            data['gains'][ind_date] += total_dividend_received
-            data['cash_in_account'][ind_date] += total_dividend_received
-
-        papers_dict[stock_name] = papers
-    data['papers_dict'] = papers_dict
+    for stock_name in lot_books.keys():
+        # daily factor of the stock value, after taking the cut of expense-ratio and loan-rate (LIBOR).
+        # all the papers of a stock grow by the same factor (see LotBook)
+        paper_factor = data['daily_factors'][stock_name][ind_date]
+        lot_books[stock_name].evolve(paper_factor)
+
+        # we assume the dividends are given on a daily basis for simplicity
+        dividend_fraction = data['dividend_fractions'][stock_name][ind_date]
+        total_dividend_received = lot_books[stock_name].get_position_value() * dividend_fraction
+        data['gains'][ind_date] += total_dividend_received
+        data['cash_in_account'][ind_date] += total_dividend_received
 
     # evolve counters
     data['days_since_invest'] += 1
@@ -278,10 +642,117 @@ def evolve_portfolio_single_day(settings, data, ind_date):
     return data
 
 
-def check_invest_criterion_reached(settings, data):
+def get_next_scheduled_event_day(settings, data, ind_date):
     """
-    Count number of days until new cash or dividends are to be reinvested
+    first day from ind_date on which cash is invested, the portfolio is rebalanced on schedule or the yearly tax is
+    due, according to the day counters (which are increased before the criteria are checked)
+    """
+    days_to_event = min(get_days_between_invests(settings) - data['days_since_invest'],
+                        get_days_between_rebalances(settings) - data['days_since_rebalance'])
+    if is_yearly_tax_active(settings):
+        days_to_event = min(days_to_event, settings['num_trading_days_in_year'] - data['days_since_start_of_year'])
+    return ind_date + max(int(np.ceil(days_to_event)) - 1, 0)
+
+
+def evolve_portfolio_segment(settings, data, ind_start, ind_end):
+    """
+    Evolve the portfolio in bulk over the days [ind_start, ind_end), on which there are no scheduled events.
+    Every array is computed with the same operations as the day by day evolution (see evolve_portfolio_single_day),
+    the growth indices with cumulative products and the cash and gains with cumulative sums of the dividends.
+    Returns the first day of the segment that needs the full daily simulation (a rebalance threshold is crossed, the
+    portfolio is nulled or a growth index needs rescaling), only the days before it are evolved.
     """
+    num_days = ind_end - ind_start
+    if num_days <= 0:
+        return ind_start
+    inds = slice(ind_start, ind_end)
+    lot_books = data['lot_books']
+    ideal_portfolio_fractions = settings['ideal_portfolio_fractions']
+    stock_names = list(ideal_portfolio_fractions.keys())
+    is_event = np.zeros(num_days, dtype=bool)
+
+    # value of each stock at the end of each day of the segment, and at the end of the day before
+    growth_indices = {}
+    values_before = {}
+    dividends = np.zeros([num_days, len(stock_names)])
+    for ind_stock, stock_name in enumerate(stock_names):
+        lot_book = lot_books[stock_name]
+        growth_index = np.cumprod(np.concatenate([[lot_book.growth_index], data['daily_factors'][stock_name][inds]]))
+        growth_indices[stock_name] = growth_index[1:]
+        is_event |= ~((growth_index[1:] > 1e-100) & (growth_index[1:] < 1e100))
+        values = lot_book.position_units * growth_index
+        values_before[stock_name] = values[:-1]
+        dividends[:, ind_stock] = values[1:] * data['dividend_fractions'][stock_name][inds]
+
+    # the total value and fractions are those of the values before the day evolves
+    total_portfolio_value = 0
+    for stock_name in stock_names:
+        total_portfolio_value = total_portfolio_value + values_before[stock_name]
+    is_event |= total_portfolio_value <= 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        portfolio_fractions = {stock_name: values_before[stock_name] / total_portfolio_value
+                               for stock_name in stock_names}
+
+    # the dividends are added to the cash day by day. negative cash (margin loan) first grows by the margin rate, so
+    # while the cash is negative it follows c[i] = a * c[i-1] + dividends[i]. dividends are positive, so once the cash
+    # is positive it stays positive
+    margin_rate_factor = 1 + settings['margin_rate_percents'] / 100.0 / settings['num_trading_days_in_year']
+    cash_start = data['cash_in_account'][ind_start - 1]
+    cash_before_dividends = np.zeros(num_days)
+    cash_in_account = np.zeros(num_days)
+    num_days_negative = 0
+    if cash_start < 0:
+        powers = margin_rate_factor ** np.arange(1, num_days + 1)
+        cash_negative = powers * (cash_start + np.cumsum(np.sum(dividends, axis=1) / powers))
+        inds_positive = np.nonzero(cash_negative >= 0)[0]
+        num_days_negative = num_days if len(inds_positive) == 0 else inds_positive[0] + 1
+        cash_in_account[:num_days_negative] = cash_negative[:num_days_negative]
+        cash_before_dividends[:num_days_negative] = margin_rate_factor * np.concatenate(
+            [[cash_start], cash_negative[:num_days_negative - 1]])
+    if num_days_negative < num_days:
+        cash = cash_start if num_days_negative == 0 else cash_in_account[num_days_negative - 1]
+        cash_in_account[num_days_negative:] = np.cumsum(
+            np.concatenate([[cash], dividends[num_days_negative:].reshape(-1)]))[len(stock_names)::len(stock_names)]
+        cash_before_dividends[num_days_negative:] = np.concatenate([[cash], cash_in_account[num_days_negative:-1]])
+    gains = np.cumsum(np.concatenate([[data['gains'][ind_start - 1]], dividends.reshape(-1)]))[
+            len(stock_names)::len(stock_names)]
+    margin_debt = np.where(cash_before_dividends < 0, - cash_before_dividends, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        margin_leverage = total_portfolio_value / (total_portfolio_value - margin_debt)
+
+    # days on which a rebalance threshold is crossed (see check_rebalancing_criterion_reached)
+    if settings['rebalance_criterion'] == 'percent_deviation':
+        for stock_name in stock_names:
+            stock_percent_ideal = ideal_portfolio_fractions[stock_name] * 100.0
+            stock_percent_curr = portfolio_fractions[stock_name] * 100.0
+            is_event |= np.abs(stock_percent_ideal - stock_percent_curr) > settings['rebalance_percent_deviation']
+    if settings['margin_leverage_target'] > 1:
+        margin_deviation_percents = np.abs(margin_leverage - settings['margin_leverage_target']) \
+                                    / settings['margin_leverage_target'] * 100.0
+        is_event |= margin_deviation_percents > settings['margin_leverage_percent_deviation']
+
+    # evolve up to the first event
+    num_days_evolved = int(np.argmax(is_event)) if np.any(is_event) else num_days
+    if num_days_evolved > 0:
+        inds_evolved = slice(ind_start, ind_start + num_days_evolved)
+        data['total_portfolio_value'][inds_evolved] = total_portfolio_value[:num_days_evolved]
+        for stock_name in stock_names:
+            data['portfolio_fractions'][stock_name][inds_evolved] = portfolio_fractions[stock_name][:num_days_evolved]
+            lot_books[stock_name].growth_index = growth_indices[stock_name][num_days_evolved - 1]
+        data['total_investment'][inds_evolved] = data['total_investment'][ind_start - 1]
+        data['taxes_paid'][inds_evolved] = data['taxes_paid'][ind_start - 1]
+        data['gains'][inds_evolved] = gains[:num_days_evolved]
+        data['cash_in_account'][inds_evolved] = cash_in_account[:num_days_evolved]
+        data['margin_debt'][inds_evolved] = margin_debt[:num_days_evolved]
+        data['margin_leverage'][inds_evolved] = margin_leverage[:num_days_evolved]
+        data['days_since_invest'] += num_days_evolved
+        data['days_since_rebalance'] += num_days_evolved
+        data['days_since_start_of_year'] += num_days_evolved
+
+    return ind_start + num_days_evolved
+
+
+def get_days_between_invests(settings):
     if settings['periodic_investment_interval'] == 'monthly':
         days_between_invests = settings['num_trading_days_in_year'] / 12.0
     elif settings['periodic_investment_interval'] == 'quarterly':
@@ -290,8 +761,14 @@ def check_invest_criterion_reached(settings, data):
         days_between_invests = settings['num_trading_days_in_year']
     else:
         raise ValueError('invalid periodic_investment_interval: ' + str(settings['periodic_investment_interval']))
+    return days_between_invests
 
-    if data['days_since_invest'] >= days_between_invests:
+
+def check_invest_criterion_reached(settings, data):
+    """
+    Count number of days until new cash or dividends are to be reinvested
+    """
+    if data['days_since_invest'] >= get_days_between_invests(settings):
         return True
     else:
         return False
@@ -316,19 +793,9 @@ def add_cash_to_portfolio(settings, data, ind_date):
         cash_list *= (1 - settings['transaction_fee_percents'] / 100.0)
 
         # buy new papers with the cash
-        papers_dict = data['papers_dict']
         for stock_name, cash_portion in zip(stock_names, cash_list):
             if cash_portion > 0:
-                paper = {}
-                paper['id'] = len(papers_dict[stock_name]) + 1
-                paper['stock_name'] = stock_name
-                paper['value_at_buy'] = cash_portion
-                paper['value_current'] = paper['value_at_buy']
-                paper['date'] = data['dates'][ind_date]
-                paper['ind_day_at_buy'] = ind_date
-                paper['status'] = 'open'
-                papers_dict[stock_name] += [paper]
-        data['papers_dict'] = papers_dict
+                data['lot_books'][stock_name].add_lot(cash_portion, ind_date)
 
         # cash was used in total
         data['number_of_buy_days'] += 1
@@ -360,6 +827,16 @@ def check_rebalancing_criterion_reached(settings, data, ind_date):
         if margin_deviation_percents > settings['margin_leverage_percent_deviation']:
             return True
 
+    if data['days_since_rebalance'] >= get_days_between_rebalances(settings):
+        return True
+
+    return False
+
+
+def get_days_between_rebalances(settings):
+    """
+    days between scheduled rebalances (infinite for rebalancing on percent deviation only)
+    """
     days_between_rebalances = np.inf
     if settings['rebalance_criterion'] == 'monthly':
         days_between_rebalances = settings['num_trading_days_in_year'] / 12.0
@@ -367,10 +844,7 @@ def check_rebalancing_criterion_reached(settings, data, ind_date):
         days_between_rebalances = settings['num_trading_days_in_year'] / 4.0
     elif settings['rebalance_criterion'] == 'yearly':
         days_between_rebalances = settings['num_trading_days_in_year']
-    if data['days_since_rebalance'] >= days_between_rebalances:
-        return True
-
-    return False
+    return days_between_rebalances
 
 
 def rebalance_portfolio(settings, data, ind_date):
@@ -388,7 +862,7 @@ def rebalance_portfolio(settings, data, ind_date):
     delta_loan = leverage_target * (total_portfolio_value - margin_debt) - total_portfolio_value
 
     # calculate how much needs to be bought or sold from each stock type
-    papers_dict = data['papers_dict']
+    lot_books = data['lot_books']
     ideal_portfolio_fractions = settings['ideal_portfolio_fractions']
     portfolio_fractions = data['portfolio_fractions']
     transfers = {}
@@ -408,29 +882,30 @@ def rebalance_portfolio(settings, data, ind_date):
             # globally take the transaction fees into account by effectively increasing the amount that needs to be sold
             amount_left_to_sell /= (1 - settings['transaction_fee_percents'] / 100.0)
 
-            # sort the papers in the order dictated by tax scheme
-            indices_papers = sort_papers_by_tax_scheme(settings, data, stock_name)
-
-            # sell papers in the order calculated above
-            papers = papers_dict[stock_name]
-            for ind_paper in indices_papers:
-                paper = papers[ind_paper]
-                if papers[ind_paper]['status'] == 'open':
-
-                    # sell papers, but if the current paper is profitable, will be added to this year's gains
-                    paper_profit = paper['value_current'] - paper['value_at_buy']
-
-                    if paper['value_current'] >= amount_left_to_sell:
-                        data['gains'][ind_date] += np.sign(paper_profit) * min(paper_profit, amount_left_to_sell)
-                        papers[ind_paper]['value_current'] -= amount_left_to_sell
-                        amount_left_to_sell = 0  # finished selling this stock type for rebalancing
-                        break
-                    else:
-                        data['gains'][ind_date] += paper_profit
-                        amount_left_to_sell -= papers[ind_paper]['value_current']
-                        papers[ind_paper]['value_current'] = 0
-                        papers[ind_paper]['status'] = 'closed'
-            papers_dict[stock_name] = papers
+            if data['aggregate_positions']:
+                data['gains'][ind_date] += lot_books[stock_name].sell_value(amount_left_to_sell)
+                continue
+
+            # sell papers in the order dictated by tax scheme
+            lot_book = lot_books[stock_name]
+            lot_book.sort_sell_order()
+            while lot_book.get_num_open_lots() > 0:
+                ind_paper = lot_book.get_next_lot()
+
+                # sell papers, but if the current paper is profitable, will be added to this year's gains
+                paper_value = lot_book.get_lot_value(ind_paper)
+                paper_profit = paper_value - lot_book.value_at_buy[ind_paper]
+
+                if paper_value >= amount_left_to_sell:
+                    data['gains'][ind_date] += np.sign(paper_profit) * min(paper_profit, amount_left_to_sell)
+                    lot_book.sell_lot_value(ind_paper, amount_left_to_sell)
+                    amount_left_to_sell = 0  # finished selling this stock type for rebalancing
+                    break
+                else:
+                    data['gains'][ind_date] += paper_profit
+                    amount_left_to_sell -= paper_value
+                    lot_book.close_lot(ind_paper)
+            lot_book.retire_closed_lots()
 
     # positive transfers are positions that need to be increased, so buy new papers accordingly
     for stock_name in stock_names:
@@ -441,17 +916,7 @@ def rebalance_portfolio(settings, data, ind_date):
             amount_to_buy *= (1 - settings['transaction_fee_percents'] / 100.0)
 
             # buy new paper
-            paper = {}
-            paper['id'] = len(papers_dict[stock_name]) + 1
-            paper['stock_name'] = stock_name
-            paper['value_at_buy'] = amount_to_buy
-            paper['value_current'] = paper['value_at_buy']
-            paper['date'] = data['dates'][ind_date]
-            paper['ind_day_at_buy'] = ind_date
-            paper['status'] = 'open'
-            papers_dict[stock_name] += [paper]
-
-    data['papers_dict'] = papers_dict
+            lot_books[stock_name].add_lot(amount_to_buy, ind_date)
 
     # update total portfolio value, cash and margin
     data['total_portfolio_value'][ind_date] += delta_loan
@@ -461,11 +926,15 @@ def rebalance_portfolio(settings, data, ind_date):
     return data
 
 
+def is_yearly_tax_active(settings):
+    return settings['tax_scheme'] != 'none' and settings['capital_gains_tax_percents'] > 0
+
+
 def check_tax_criterion_reached(settings, data):
     """
     check if time to pay tax arrived
     """
-    if settings['tax_scheme'] != 'none' and settings['capital_gains_tax_percents'] > 0:
+    if is_yearly_tax_active(settings):
         if data['days_since_start_of_year'] >= settings['num_trading_days_in_year']:
             data['days_since_start_of_year'] = 0
             return True
@@ -497,7 +966,7 @@ def sell_papers_for_tax(settings, data, ind_date):
             data['simulation_status'] = 'failed'
             return data
 
-        papers_dict = data['papers_dict']
+        lot_books = data['lot_books']
         ideal_portfolio_fractions = settings['ideal_portfolio_fractions']
         stock_names = ideal_portfolio_fractions.keys()
         for stock_name in stock_names:
@@ -505,39 +974,33 @@ def sell_papers_for_tax(settings, data, ind_date):
             # splitting the tax to pay between the different stock types, for simplicity
             G = gains * data['portfolio_fractions'][stock_name][ind_date]
 
-            # sort the papers in the order dictated by tax scheme
-            papers = papers_dict[stock_name]
-            indices_papers = sort_papers_by_tax_scheme(settings, data, stock_name)
-
-            # sell papers in the order calculated above
-            for ind_paper in indices_papers:
-
-                paper = papers[ind_paper]
-                if papers[ind_paper]['status'] == 'open':
-
-                    V = paper['value_current']
-                    P = paper['value_current'] - paper['value_at_buy']
-
-                    G_transition = abs(P) * (1 - np.sign(P) * cgt) / cgt
-                    if G <= G_transition:
-                        delta_T = G * cgt / (1 - np.sign(P) * cgt)
-                    else:
-                        delta_T = (G + P) * cgt
-
-                    if V > delta_T:
-                        # the paper has enough value to cover the yearly gains
-                        data['taxes_paid'][ind_date] += delta_T
-                        G = 0
-                        papers[ind_paper]['value_current'] -= delta_T
-                        break
-                    else:
-                        # this paper does not have enough, so we fully sell it and continue to the next one
-                        data['taxes_paid'][ind_date] += V
-                        G = (delta_T - V) / cgt
-                        papers[ind_paper]['value_current'] = 0
-                        papers[ind_paper]['status'] = 'closed'
-
-            papers_dict[stock_name] = papers
+            # sell papers in the order dictated by tax scheme
+            lot_book = lot_books[stock_name]
+            lot_book.sort_sell_order()
+            while lot_book.get_num_open_lots() > 0:
+                ind_paper = lot_book.get_next_lot()
+
+                V = lot_book.get_lot_value(ind_paper)
+                P = V - lot_book.value_at_buy[ind_paper]
+
+                G_transition = abs(P) * (1 - np.sign(P) * cgt) / cgt
+                if G <= G_transition:
+                    delta_T = G * cgt / (1 - np.sign(P) * cgt)
+                else:
+                    delta_T = (G + P) * cgt
+
+                if V > delta_T:
+                    # the paper has enough value to cover the yearly gains
+                    data['taxes_paid'][ind_date] += delta_T
+                    G = 0
+                    lot_book.sell_lot_value(ind_paper, delta_T)
+                    break
+                else:
+                    # this paper does not have enough, so we fully sell it and continue to the next one
+                    data['taxes_paid'][ind_date] += V
+                    G = (delta_T - V) / cgt
+                    lot_book.close_lot(ind_paper)
+            lot_book.retire_closed_lots()
 
             # check tax was fully paid for this stock type
             if G != 0:
@@ -545,8 +1008,6 @@ def sell_papers_for_tax(settings, data, ind_date):
                 data['simulation_status'] = 'failed'
                 return data
 
-        data['papers_dict'] = papers_dict
-
         # recalculate the portfolio value and fractions
         data = calculate_portfolio_fractions(settings, data, ind_date)
 
@@ -559,54 +1020,18 @@ def sell_papers_for_tax(settings, data, ind_date):
     return data
 
 
-def sort_papers_by_tax_scheme(settings, data, stock_name=None):
-    """
-    Sort the papers in different orders according to the tax scheme
-    """
-
-    # pick a list of papers to sort
-    if stock_name is not None:
-        papers = data['papers_dict'][stock_name]
-    else:
-        papers = []
-        for stock_name in data['papers_dict'].keys():
-            papers += data['papers_dict'][stock_name]
-
-    # sort by the requested method
-    if settings['tax_scheme'] == 'FIFO':
-        # past to future
-        paper_date_indices = [paper['ind_day_at_buy'] for paper in papers]
-        indices_papers = np.argsort(paper_date_indices)
-    elif settings['tax_scheme'] == 'LIFO':
-        # future to past
-        paper_date_indices = [paper['ind_day_at_buy'] for paper in papers]
-        indices_papers = np.argsort(paper_date_indices)[::-1]
-    elif settings['tax_scheme'] in ['optimized', 'none']:
-        # order the papers from least to most profitable at current date
-        paper_profits = [paper['value_current'] - paper['value_at_buy'] for paper in papers]
-        indices_papers = np.argsort(paper_profits)
-    else:
-        raise ValueError('invalid tax_scheme: ' + str(settings['tax_scheme']))
-
-    return indices_papers
-
-
 def calculate_portfolio_fractions(settings, data, ind_date):
     """
     add end of trading day, sum up the current fractions and total value
     """
     # print(ind_date)
 
-    papers_dict = data['papers_dict']
     ideal_portfolio_fractions = settings['ideal_portfolio_fractions']
     stock_names = ideal_portfolio_fractions.keys()
     curr_total_portfolio_value = 0
     portfolio_fractions = {}
     for stock_name in stock_names:
-        portfolio_fractions[stock_name] = 0
-        papers = papers_dict[stock_name]
-        for paper in papers:
-            portfolio_fractions[stock_name] += paper['value_current']
+        portfolio_fractions[stock_name] = data['lot_books'][stock_name].get_position_value()
         curr_total_portfolio_value += portfolio_fractions[stock_name]
 
     if curr_total_portfolio_value <= 0:
@@ -643,16 +1068,16 @@ def track_paper_status(settings, data):
     """
     papers_buy_days = []
     papers_status_colors = []
-    papers_dict = data['papers_dict']
-    for stock_name in papers_dict.keys():
-        papers = papers_dict[stock_name]
-        for paper in papers:
-            papers_buy_days += [paper['ind_day_at_buy']]
-            if paper['status'] == 'open':
-                papers_status_colors += ['g']
-            else:
-                papers_status_colors += ['r']
-    portfolio_values_at_buy_days = data['total_portfolio_value'][papers_buy_days]
+    # aggregated positions do not keep the individual papers, and the summary record does not track them
+    lot_books = data['lot_books'].values() if not data['aggregate_positions'] and settings['record'] == 'full' else []
+    for lot_book in lot_books:
+        papers_buy_days += lot_book.ind_day_at_buy[:len(lot_book)].tolist()
+        papers_status_colors += ['g' if is_open else 'r' for is_open in lot_book.is_open[:len(lot_book)]]
+        # closed papers, retired from the live arrays
+        papers_buy_days += lot_book.get_archived_ind_day_at_buy().tolist()
+        papers_status_colors += ['r'] * lot_book.num_archived_lots
+    portfolio_values_at_buy_days = data['total_portfolio_value'][papers_buy_days] if settings['record'] == 'full' \
+        else np.array([])
 
     data['papers_buy_days'] = papers_buy_days
     data['papers_status_colors'] = papers_status_colors
@@ -673,13 +1098,8 @@ def calculate_total_portfolio_yield(settings, data):
 
     if data['simulation_status'] == 'nominal':
         total_profit = 0
-
-        papers_dict = data['papers_dict']
-        for stock_name in papers_dict.keys():
-            papers = papers_dict[stock_name]
-            for paper in papers:
-                if paper['status'] == 'open':
-                    total_profit += paper['value_current'] - paper['value_at_buy']
+        for lot_book in data['lot_books'].values():
+            total_profit += lot_book.get_unrealized_profit()
 
         # use carried over losses from previous years, if they exist
         if data['gains'][-1] < 0:
@@ -709,20 +1129,17 @@ def calculate_risk_metrics(settings, data):
     """
     calculate risk metrics that characterize the volatility of the portfolio which is not important
     in the long run, but can be hard psychologically.
+    The full record has all the metrics of calculate_risk_metrics_batch, the summary record only the streamed
+    yield_min, yield_max and max_drawdown.
     """
-    if data['simulation_status'] == 'nominal':
+    if data['simulation_status'] == 'nominal' and settings['record'] == 'summary':
+        data = update_risk_metrics(settings, data, len(data['dates']))
 
-        yield_history = (data['total_portfolio_value'] - data['margin_debt']) / data['total_investment']
-        data['yield_min'] = np.nanmin(yield_history)
-        data['yield_max'] = np.nanmax(yield_history)
+    elif data['simulation_status'] == 'nominal':
 
-        yield_relative_to_cum_max = 0 * yield_history
-        curr_max = 0
-        for i, curr_yield in enumerate(yield_history):
-            curr_max = np.nanmax([curr_max, curr_yield])
-            yield_relative_to_cum_max[i] = curr_yield / curr_max
-        data['drawdown'] = 1 - yield_relative_to_cum_max
-        data['max_drawdown'] = np.max(data['drawdown'])
+        yield_history = (data['total_portfolio_value'] - data['margin_debt']) / data['total_investment']
+        data.update(calculate_risk_metrics_batch(yield_history, settings['num_trading_days_in_year']))
+        data['drawdown'] = get_drawdown(yield_history)
 
     else:
         data['yield_min'] = -1.0
@@ -730,3 +1147,22 @@ def calculate_risk_metrics(settings, data):
         data['max_drawdown'] = 2.0
 
     return data
+
+
+def update_risk_metrics(settings, data, ind_end):
+    """
+    stream the yield history of the days up to ind_end that were not streamed yet into the running risk metrics (the
+    same metrics as calculate_risk_metrics, without keeping the history)
+    """
+    inds = slice(data['ind_date_risk_metrics'], ind_end)
+    yield_history = (data['total_portfolio_value'][inds] - data['margin_debt'][inds]) / data['total_investment'][inds]
+    data['ind_date_risk_metrics'] = ind_end
+    if len(yield_history) == 0:
+        return data
+
+    data['yield_min'] = np.nanmin(np.append(yield_history, data['yield_min']))
+    data['yield_max'] = np.nanmax(np.append(yield_history, data['yield_max']))
+    yield_cum_max = np.fmax.accumulate(np.append(data['yield_peak'], yield_history))[1:]
+    data['yield_peak'] = yield_cum_max[-1]
+    data['max_drawdown'] = np.max(np.append(1 - yield_history / yield_cum_max, data['max_drawdown']))
+    return data
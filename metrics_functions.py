@@ -0,0 +1,131 @@
+import numpy as np
+import scipy.stats
+
+
+def get_drawdown(yield_history):
+    """
+    Drawdown of each day relative to the running maximum of the yield history (which starts at 0), along the last
+    axis (days). Missing days (nan) do not change the running maximum.
+    """
+    yield_history = np.asarray(yield_history, dtype=float)
+    yield_cum_max = np.fmax.accumulate(np.fmax(yield_history, 0), axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - yield_history / yield_cum_max
+
+
+def get_max_run_length(is_true):
+    """
+    length of the longest run of consecutive True values along the last axis
+    """
+    inds = np.arange(is_true.shape[-1])
+    inds_last_false = np.maximum.accumulate(np.where(is_true, -1, inds), axis=-1)
+    return np.max(inds - inds_last_false, axis=-1, initial=0)
+
+
+def calculate_risk_metrics_batch(yield_history, num_trading_days_in_year, risk_free_rate_percents=0.0,
+                                 return_percentiles=(5, 50, 95)):
+    """
+    Risk metrics of a batch of yield histories (realizations x days), or of a single history (days), computed for all
+    the realizations together along the days axis.
+    Returns a dict of the metrics per realization (scalars for a single history):
+    yield_min, yield_max, max_drawdown - as in calculate_risk_metrics.
+    cagr_percents - compound annual growth rate of the yield.
+    volatility_percents - annualized standard deviation of the daily changes of the yield.
+    sharpe_ratio, sortino_ratio - annualized mean daily change of the yield in excess of the risk free rate, relative to
+    the volatility or to the downside deviation (of the negative daily changes only).
+    ulcer_index_percents - root mean square of the drawdown.
+    time_under_water_percents - percent of the days in drawdown, and max_years_under_water the longest drawdown.
+    one_year_return_percents_<p> - percentiles of the change of the yield over all the one year windows.
+    """
+    yield_history = np.asarray(yield_history, dtype=float)
+    num_days = yield_history.shape[-1]
+    metrics = {}
+
+    metrics['yield_min'] = np.nanmin(yield_history, axis=-1)
+    metrics['yield_max'] = np.nanmax(yield_history, axis=-1)
+
+    drawdown = get_drawdown(yield_history)
+    metrics['max_drawdown'] = np.max(drawdown, axis=-1)
+    metrics['ulcer_index_percents'] = np.sqrt(np.nanmean((100.0 * drawdown) ** 2, axis=-1))
+    is_under_water = drawdown > 0
+    metrics['time_under_water_percents'] = 100.0 * np.mean(is_under_water, axis=-1)
+    metrics['max_years_under_water'] = get_max_run_length(is_under_water) / num_trading_days_in_year
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        num_years = (num_days - 1) / num_trading_days_in_year
+        total_growth = yield_history[..., -1] / yield_history[..., 0]
+        metrics['cagr_percents'] = 100.0 * (np.power(total_growth, 1.0 / num_years) - 1)
+
+        # annualized statistics of the daily changes of the yield
+        daily_changes = yield_history[..., 1:] / yield_history[..., :-1] - 1
+        excess_return = np.nanmean(daily_changes, axis=-1) * num_trading_days_in_year - risk_free_rate_percents / 100.0
+        volatility = np.nanstd(daily_changes, axis=-1) * np.sqrt(num_trading_days_in_year)
+        downside_deviation = np.sqrt(np.nanmean(np.minimum(daily_changes, 0) ** 2, axis=-1)) \
+                             * np.sqrt(num_trading_days_in_year)
+        metrics['volatility_percents'] = 100.0 * volatility
+        metrics['sharpe_ratio'] = excess_return / volatility
+        metrics['sortino_ratio'] = excess_return / downside_deviation
+
+        # changes of the yield over all the (overlapping) one year windows
+        if num_days > num_trading_days_in_year:
+            one_year_changes = yield_history[..., num_trading_days_in_year:] \
+                               / yield_history[..., :-num_trading_days_in_year] - 1
+            one_year_percentiles = np.nanpercentile(100.0 * one_year_changes, return_percentiles, axis=-1)
+        else:
+            one_year_percentiles = np.nan * np.zeros((len(return_percentiles),) + yield_history.shape[:-1])
+    for percentile, one_year_percentile in zip(return_percentiles, one_year_percentiles):
+        metrics['one_year_return_percents_' + str(percentile)] = one_year_percentile
+
+    return metrics
+
+
+def get_percentile_confidence_interval(values, percentile, confidence_level_percents=95):
+    """
+    Distribution free confidence interval of a percentile of a sample, between the order statistics whose ranks bound
+    the number of values below the percentile (binomial) at the confidence level.
+    The interval is (-inf, inf) if the sample is too small for the confidence level.
+    """
+    values = np.sort(np.asarray(values, dtype=float))
+    num_values = len(values)
+    alpha = 1 - confidence_level_percents / 100.0
+    rank_low = int(scipy.stats.binom.ppf(alpha / 2, num_values, percentile / 100.0))
+    rank_high = int(scipy.stats.binom.ppf(1 - alpha / 2, num_values, percentile / 100.0)) + 1
+    if rank_low < 1 or rank_high > num_values:
+        return -np.inf, np.inf
+    return values[rank_low - 1], values[rank_high - 1]
+
+
+def get_probability_confidence_interval(num_events, num_trials, confidence_level_percents=95):
+    """
+    Wilson score confidence interval of a probability estimated from num_events out of num_trials
+    """
+    if num_trials == 0:
+        return 0.0, 1.0
+    z = scipy.stats.norm.ppf(1 - (1 - confidence_level_percents / 100.0) / 2)
+    p = num_events / num_trials
+    center = (p + z ** 2 / (2 * num_trials)) / (1 + z ** 2 / num_trials)
+    half_width = z / (1 + z ** 2 / num_trials) * np.sqrt(p * (1 - p) / num_trials + z ** 2 / (4 * num_trials ** 2))
+    return center - half_width, center + half_width
+
+
+def get_bootstrap_precision(yield_list, percentiles=(5, 50, 95), yield_cut_off=1.0, confidence_level_percents=95):
+    """
+    Precision of the bootstrap estimates of the yield distribution from the realizations so far, at the (two-sided)
+    confidence level:
+    percentile_ci_relative_width_<p> - width of the confidence interval of each percentile relative to its value (the
+    absolute width if the percentile is 0, e.g. when many realizations were nulled).
+    p_lose_ci_width - width of the confidence interval of the probability to end below yield_cut_off.
+    """
+    yield_list = np.asarray(yield_list, dtype=float)
+    precision = {}
+    for percentile in percentiles:
+        ci_low, ci_high = get_percentile_confidence_interval(yield_list, percentile, confidence_level_percents)
+        ci_width = ci_high - ci_low
+        yield_percentile = abs(np.percentile(yield_list, percentile))
+        if yield_percentile > 0:
+            ci_width /= yield_percentile
+        precision['percentile_ci_relative_width_' + str(percentile)] = ci_width
+    ci_low, ci_high = get_probability_confidence_interval(np.sum(yield_list < yield_cut_off), len(yield_list),
+                                                          confidence_level_percents)
+    precision['p_lose_ci_width'] = ci_high - ci_low
+    return precision
@@ -0,0 +1,87 @@
+import copy
+import numpy as np
+from settings_functions import define_default_settings
+from market_functions import simulate_portfolio_evolution, LotBook
+from batch_market_functions import simulate_portfolio_evolution_batch
+
+# regression checks of the simulation, run with: python run_regression_checks.py
+
+# a margin call that sells the entire portfolio must end the simulation as failed (a nulled portfolio), also when the
+# units left after selling all the papers are a rounding residue
+liquidation_configs = []
+liquidation_configs += [({'TQQQ': 1.0}, 3.0, seed) for seed in [5, 7]]
+liquidation_configs += [({'NDX100TRx4': 1.0}, 2.5, seed) for seed in [5, 7, 8]]
+
+for ideal_portfolio_fractions, margin_leverage_target, seed in liquidation_configs:
+    # the papers are kept in a LotBook, or in an AggregatedPosition when no tax applies at all
+    for tax_scheme, total_sell_capital_gains_tax_percents in [('optimized', 25), ('none', 25), ('none', 0)]:
+        settings = define_default_settings()
+        settings['ideal_portfolio_fractions'] = ideal_portfolio_fractions
+        settings['margin_leverage_target'] = margin_leverage_target
+        settings['periodic_investment'] = 1
+        settings['generate_synthetic_realization'] = True
+        settings['seed'] = seed
+        settings['tax_scheme'] = tax_scheme
+        settings['total_sell_capital_gains_tax_percents'] = total_sell_capital_gains_tax_percents
+        if tax_scheme == 'none':
+            settings['capital_gains_tax_percents'] = 0
+
+        data = simulate_portfolio_evolution(copy.deepcopy(settings))
+        label = str(ideal_portfolio_fractions) + ', margin_leverage_target = ' + str(margin_leverage_target) \
+                + ', seed = ' + str(seed) + ', tax_scheme = ' + tax_scheme \
+                + ', total_sell_capital_gains_tax_percents = ' + str(total_sell_capital_gains_tax_percents)
+        if data['simulation_status'] != 'failed' or data['total_yield'] != -1:
+            raise AssertionError('liquidated portfolio not failed: ' + label + ', total_yield = '
+                                 + str(data['total_yield']))
+        print('ok: ' + label)
+
+# the batch simulation detects the nulled portfolios the same as the serial simulation (the same failed realizations)
+for ideal_portfolio_fractions, margin_leverage_target in [({'TQQQ': 1.0}, 3.0), ({'NDX100TRx4': 1.0}, 2.5)]:
+    for total_sell_capital_gains_tax_percents in [25, 0]:
+        settings = define_default_settings()
+        settings['ideal_portfolio_fractions'] = ideal_portfolio_fractions
+        settings['margin_leverage_target'] = margin_leverage_target
+        settings['periodic_investment'] = 1
+        settings['generate_synthetic_realization'] = True
+        settings['tax_scheme'] = 'none'
+        settings['capital_gains_tax_percents'] = 0
+        settings['total_sell_capital_gains_tax_percents'] = total_sell_capital_gains_tax_percents
+
+        seeds = list(range(10))
+        results = simulate_portfolio_evolution_batch(copy.deepcopy(settings), seeds)
+        for ind_real, seed in enumerate(seeds):
+            settings['seed'] = seed
+            data = simulate_portfolio_evolution(copy.deepcopy(settings))
+            label = str(ideal_portfolio_fractions) + ', margin_leverage_target = ' + str(margin_leverage_target) \
+                    + ', seed = ' + str(seed) \
+                    + ', total_sell_capital_gains_tax_percents = ' + str(total_sell_capital_gains_tax_percents)
+            if not np.isclose(results['total_yield'][ind_real], data['total_yield'], rtol=1e-9) \
+                    or not np.isclose(results['max_drawdown'][ind_real], data['max_drawdown'], rtol=1e-9):
+                raise AssertionError('batch and serial simulations differ: ' + label + ', total_yield = '
+                                     + str(results['total_yield'][ind_real]) + ' / ' + str(data['total_yield']))
+        print('ok: batch ' + label)
+
+# the 'optimized' sell order must not depend on the rounding of the units of the papers (papers bought on the same day
+# are tied at zero profit): starting the growth index of the LotBooks at other values only changes the rounding
+lot_book_init = LotBook.__init__
+total_yields = []
+for growth_index in [1.0, 3.0, 0.7]:
+    def lot_book_init_with_growth_index(self, *args, **kwargs):
+        lot_book_init(self, *args, **kwargs)
+        self.growth_index = growth_index
+    LotBook.__init__ = lot_book_init_with_growth_index
+    settings = define_default_settings()
+    settings['ideal_portfolio_fractions'] = {'TMF': 0.5, 'TQQQ': 0.5}
+    settings['rebalance_criterion'] = 'quarterly'
+    settings['periodic_investment'] = 1
+    settings['tax_scheme'] = 'optimized'
+    settings['generate_synthetic_realization'] = True
+    settings['seed'] = 11
+    settings['date_start'] = '2010-03-01'
+    settings['date_end'] = '2020-09-30'
+    total_yields += [simulate_portfolio_evolution(copy.deepcopy(settings))['total_yield']]
+LotBook.__init__ = lot_book_init
+if not np.allclose(total_yields, total_yields[0], rtol=1e-9):
+    raise AssertionError('optimized sell order depends on the rounding of the units, total_yield = '
+                         + str(total_yields))
+print('ok: optimized sell order of TMF/TQQQ, seed = 11')
@@ -1,5 +1,5 @@
 import matplotlib
-from data_functions import load_stock_data
+from data_functions import load_stock_data, market_data_store
 from aux_functions import get_year_labels
 import numpy as np
 from cycler import cycler
@@ -9,6 +9,7 @@ from settings_functions import define_default_settings
 from market_functions import simulate_portfolio_evolution
 import os
 from slurm_functions import get_script_bootstrap_slave
+from bootstrap_functions import get_root_entropy
 from slurmpy.slurmpy import Slurm
 
 pwd = os.getcwd()
@@ -121,12 +122,32 @@ stock1_list += ['VUSTX', 'VUSTX2', 'VUSTX', 'VUSTX2']
 stock2_list += [  'VOO',    'SSO',   'QQQ',    'QLD']
 margin_lev_list += [1.8, 1.8, 1.8, 1.8]
 
+# all the configurations of the sweep are simulated on the same market paths (common random numbers), drawn from
+# independent random streams derived from the root entropy of the sweep (recorded in the result files)
+root_entropy = get_root_entropy()
+# root_entropy = 123456789  # regenerate the realizations of a previous sweep
+print('root_entropy = ' + str(root_entropy))
+
+# the slaves of the sweep on a node share the market data of all the series of the sweep, see bootstrap_portfolio_slave.
+# The last slave on a node removes the panel from /dev/shm, but slaves that are killed (e.g. by the slurm time limit)
+# do not, so after such a sweep remove the files /dev/shm/market_panel_sweep_<root_entropy>* on the nodes.
+_, _, underlying_index, _ = market_data_store.get_stock_parameters(stock1_list + stock2_list)
+market_panel_name = 'sweep_' + str(root_entropy)
+market_panel_stock_names = sorted(set(underlying_index.values()))
+
+# with the batch engine, all the fractions of a stock pair are simulated in a single job over the same paths
+# (still with a result file per fraction)
+fractions_in_single_job = True
+# fractions_in_single_job = False
+
 total_number_of_runs = len(frac_list) * len(stock1_list)
 cnt = 0
 # for stock1, stock2 in zip(stock1_list, stock2_list):
 #     print('stock1 ' + stock1 + ', stock2 ' + stock2)
 for stock1, stock2, margin_lev in zip(stock1_list, stock2_list, margin_lev_list):
     print('stock1 ' + stock1 + ', stock2 ' + stock2)
+    portfolio_fractions_list = []
+    sim_name_list = []
     for frac in frac_list:
         print('frac = ' + str(frac))
 
@@ -188,13 +209,39 @@ for stock1, stock2, margin_lev in zip(stock1_list, stock2_list, margin_lev_list)
         bootstrap_params['save_dir'] = save_dir
         bootstrap_params['sim_name'] = sim_name
         bootstrap_params['num_realizations'] = num_realizations
+        bootstrap_params['root_entropy'] = root_entropy
+        bootstrap_params['market_panel_name'] = market_panel_name
+        bootstrap_params['market_panel_stock_names'] = market_panel_stock_names
+        # bootstrap_params['ind_realization_first'] = 0  # shard of the realizations of the sweep
+        # the batch engine simulates all the realizations together, but only without yearly capital gains tax
+        bootstrap_params['engine'] = 'batch' if settings['tax_scheme'] == 'none' else 'serial'
+        # stop before num_realizations once the yield percentiles and p_lose are estimated precisely enough
+        # bootstrap_params['percentile_ci_relative_width'] = 0.02
+        # bootstrap_params['p_lose_ci_width'] = 0.01
+        # bootstrap_params['chunk_size'] = 200
+
+        if fractions_in_single_job and bootstrap_params['engine'] == 'batch':
+            portfolio_fractions_list += [settings['ideal_portfolio_fractions']]
+            sim_name_list += [sim_name]
+            if frac != frac_list[-1]:
+                os.chdir(pwd)
+                continue
+            bootstrap_params['portfolio_fractions_list'] = portfolio_fractions_list
+            bootstrap_params['sim_name_list'] = sim_name_list
+            sim_name = stock1 + '_' + stock2 + '_fractions'
+            if margin_lev > 1:
+                sim_name += '_mX' + str(margin_lev)
+            bootstrap_params['sim_name'] = sim_name
+
+        # every job (configuration) on its own random paths instead of the common paths of the sweep
+        # bootstrap_params['config_key'] = sim_name
 
         command = bootstrap_script \
                   + ' --settings "' + str(settings) + '"' \
                   + ' --bootstrap_params "' + str(bootstrap_params) + '"'
         s = Slurm(sim_name, slurm_kwargs=slurm_kwargs)
         s.run(command)
-        cnt += 1
+        cnt += len(bootstrap_params.get('sim_name_list', [sim_name]))
         print('run # ' + str(cnt) + ' / ' + str(total_number_of_runs))
 
         os.chdir(pwd)
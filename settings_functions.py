@@ -87,8 +87,19 @@ def define_default_settings(settings=None):
     if 'num_correlation_days' not in settings:
         settings['num_correlation_days'] = 5
 
+    # resampling of the synthetic realizations, in blocks of num_correlation_days days (on average)
+    if 'bootstrap_method' not in settings:
+        settings['bootstrap_method'] = 'moving_block'
+        # settings['bootstrap_method'] = 'circular_block'
+        # settings['bootstrap_method'] = 'stationary'
+
     if 'synthetic_period_years' not in settings:
         settings['synthetic_period_years'] = 10
         # settings['synthetic_period_years'] = 35
 
+    # record the full per-day history of the simulation, or only the summary (final yields and risk metrics)
+    if 'record' not in settings:
+        settings['record'] = 'full'
+        # settings['record'] = 'summary'
+
     return settings